@@ -0,0 +1,311 @@
+from fish_tracking import Aggregator, StationMapper
+from timer import Timer, current_rss_mb, peak_rss_mb
+from datetime import datetime, timedelta
+from multiprocessing import Process, Queue
+from time import strptime
+import click
+import json
+import os
+import platform
+import subprocess
+import numpy as np
+import pandas as pd
+
+LAYOUTS = ['vliz', 'vliz_2', 'inbo', 'vue_export']
+STAGES = ['parse_detections', 'check_stationnames', 'aggregate']
+# rows generated and written at once
+GENERATE_CHUNKSIZE = 1000000
+# share of the stations that still has an old name in the exports and needs the station mapping
+OLD_NAME_FRACTION = 0.1
+
+def legacy_parse_timestamps(inseries, formats):
+    """Row-by-row parsing as done by the parse_* methods before the vectorized engine"""
+    for fmt in formats[:-1]:
+        try:
+            return inseries.apply(lambda x: datetime(*strptime(x, fmt)[:6]))
+        except:
+            pass
+    return inseries.apply(lambda x: datetime(*strptime(x, formats[-1])[:6]))
+
+def timestamp_strings(rows, fmt):
+    start = datetime(2015, 1, 1)
+    return pd.Series([(start + timedelta(seconds=37 * i)).strftime(fmt) for i in xrange(rows)])
+
+#=======================
+# Synthetic detections
+#=======================
+
+def receiver_ids(stations):
+    return np.array(['VR2W-{0}'.format(100000 + i) for i in range(stations)], dtype=object)
+
+def station_names(stations):
+    """New station names, and the names the receiver exports use for them"""
+    new_names = np.array(['ws-{0}'.format(i) for i in range(stations)], dtype=object)
+    export_names = new_names.copy()
+    old = np.arange(stations) < int(stations * OLD_NAME_FRACTION)
+    export_names[old] = ['Station {0}'.format(i) for i in np.flatnonzero(old)]
+    return new_names, export_names
+
+def write_station_mapping(path, stations):
+    new_names, export_names = station_names(stations)
+    old = new_names != export_names
+    pd.DataFrame(data={
+        'receiver_id': receiver_ids(stations)[old],
+        'old_name': export_names[old],
+        'new_name': new_names[old]
+    }, columns=['receiver_id', 'old_name', 'new_name']).to_csv(path, index=False)
+
+def generate_detections(rows, transmitters=2000, stations=300, seed=42):
+    """
+    Yield chunks of synthetic detections (timestamp, transmitter, stationname, receiver) with rows rows in total. Fish
+    visit a station for a geometric number of detections (20 on average), pinging every 60 to 180 seconds, and visits
+    start at random moments of a year, so there are gaps of hours to weeks between them.
+    """
+    random = np.random.RandomState(seed)
+    _, export_names = station_names(stations)
+    receivers = receiver_ids(stations)
+    tags = np.array(['A69-1601-{0}'.format(10000 + i) for i in range(transmitters)], dtype=object)
+    start = np.datetime64('2015-01-01T00:00:00').astype('datetime64[s]').astype('i8')
+    remaining = rows
+    while remaining > 0:
+        size = min(remaining, GENERATE_CHUNKSIZE)
+        lengths = random.geometric(1 / 20.0, size=size // 10 + 1)
+        lengths = lengths[np.cumsum(lengths) - lengths < size]
+        lengths[-1] -= lengths.sum() - size
+        visit = np.repeat(np.arange(len(lengths)), lengths)
+        position = np.arange(size) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        tag = random.randint(0, transmitters, size=len(lengths))[visit]
+        station = random.randint(0, stations, size=len(lengths))[visit]
+        visit_start = start + random.randint(0, 365 * 86400, size=len(lengths))[visit]
+        ping_delay = random.randint(60, 181, size=len(lengths))[visit]
+        timestamps = visit_start + position * ping_delay + random.randint(0, 10, size=size)
+        yield pd.DataFrame(data={
+            'timestamp': (timestamps * 10 ** 9).astype('datetime64[ns]'),
+            'transmitter': tags[tag],
+            'stationname': export_names[station],
+            'receiver': receivers[station]
+        })
+        remaining -= size
+
+def layout_dataframe(detections, layout):
+    """Format normalized detections as a receiver export of the given layout"""
+    timestamps = pd.DatetimeIndex(detections['timestamp'])
+    empty = ''
+    if layout == 'vliz':
+        data = [
+            ('Date(UTC)', timestamps.strftime('%Y-%m-%d')),
+            ('Time(UTC)', timestamps.strftime('%H:%M:%S')),
+            ('Receiver', detections['receiver'].values),
+            ('Transmitter', detections['transmitter'].values),
+            ('TransmitterName', empty),
+            ('TransmitterSerial', empty),
+            ('SensorValue', empty),
+            ('SensorUnit', empty),
+            ('StationName', detections['stationname'].values),
+            ('Latitude', '+0'),
+            ('Longitude', '+0')
+        ]
+    elif layout == 'vliz_2':
+        data = [
+            ('Date and Time (UTC)', timestamps.strftime('%Y-%m-%d %H:%M:%S')),
+            ('Receiver', detections['receiver'].values),
+            ('Transmitter', detections['transmitter'].values),
+            ('Transmitter Name', empty),
+            ('Transmitter Serial', empty),
+            ('Sensor Value', empty),
+            ('Sensor Unit', empty),
+            ('Station Name', detections['stationname'].values),
+            ('Latitude', '+0'),
+            ('Longitude', '+0')
+        ]
+    elif layout == 'inbo':
+        code_space = detections['transmitter'].str.rsplit('-', n=1).str
+        data = [
+            ('Date/Time', timestamps.strftime('%d/%m/%Y %H:%M')),
+            ('Code Space', code_space[0].values),
+            ('ID', code_space[1].values),
+            ('Sensor 1', empty),
+            ('Units 1', empty),
+            ('Sensor 2', empty),
+            ('Units 2', empty),
+            ('Transmitter Name', empty),
+            ('Transmitter S/N', empty),
+            ('Receiver Name', detections['receiver'].values),
+            ('Receiver S/N', detections['receiver'].str[5:].values),
+            ('Station Name', detections['stationname'].values),
+            ('Station Latitude', 0),
+            ('Station Longitude', 0)
+        ]
+    elif layout == 'vue_export':
+        data = [
+            ('date_time_utc', timestamps.strftime('%Y-%m-%d %H:%M:%S')),
+            ('receiver_id', detections['receiver'].values),
+            ('transmitter_id', detections['transmitter'].values),
+            ('old_station_name', empty),
+            ('station_name', detections['stationname'].values),
+            ('latitude', empty),
+            ('longitude', empty)
+        ]
+    else:
+        raise Exception('Unknown layout {0}'.format(layout))
+    return pd.DataFrame(data=dict(data), index=detections.index, columns=[name for name, values in data])
+
+def write_detections(path, layout, rows, transmitters=2000, stations=300, seed=42):
+    header = True
+    with open(path, 'w') as f:
+        for detections in generate_detections(rows, transmitters, stations, seed):
+            layout_dataframe(detections, layout).to_csv(f, header=header, index=False)
+            header = False
+
+def dataset(workdir, layout, rows, transmitters, stations, seed):
+    """Return the paths of the synthetic file and station mapping, generating them if they do not exist yet"""
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    name = '{0}-{1}-{2}-{3}-{4}'.format(layout, rows, transmitters, stations, seed)
+    path = os.path.join(workdir, name + '.csv')
+    mapping = os.path.join(workdir, 'station_names-{0}.csv'.format(stations))
+    if not os.path.exists(mapping):
+        write_station_mapping(mapping, stations)
+    if not os.path.exists(path):
+        write_detections(path + '.tmp', layout, rows, transmitters, stations, seed)
+        os.rename(path + '.tmp', path)
+    return path, mapping
+
+#=======================
+# Measurements
+#=======================
+
+def measure_stage(stage, path, mapping, rows, transmitters, stations, seed, queue):
+    """Run one stage in this (fresh) process and put its measurements on queue"""
+    agg = Aggregator()
+    if stage == 'parse_detections':
+        setup = lambda: None
+        run = lambda data: agg.parse_detections(path, station_mapping=mapping)
+    elif stage == 'check_stationnames':
+        # the mapping file is read outside of the timed stage
+        setup = lambda: (pd.concat(generate_detections(rows, transmitters, stations, seed))['stationname'],
+                         StationMapper(mapping))
+        run = lambda data: agg.check_stationnames(*data)
+    elif stage == 'aggregate':
+        def setup():
+            detections = pd.concat(generate_detections(rows, transmitters, stations, seed))
+            detections['stationname'] = StationMapper(mapping).map(detections['stationname'])
+            return detections
+        run = lambda data: agg.aggregate(data, minutes_delta=30)
+    data = setup()
+    start_rss = current_rss_mb()
+    with Timer() as timer:
+        result = run(data)
+    queue.put({
+        'seconds': timer.secs,
+        'rows_per_sec': rows / timer.secs if timer.secs > 0 else None,
+        'rows_out': len(result) if hasattr(result, '__len__') else None,
+        'start_rss_mb': start_rss,
+        'peak_rss_mb': peak_rss_mb()
+    })
+
+def environment():
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        'revision': revision,
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'date': datetime.utcnow().isoformat()
+    }
+
+@click.group()
+def benchmark():
+    pass
+
+@click.command()
+@click.option('--rows', default=1000000, help='number of timestamps to parse (default: 1000000)')
+def timestamps(rows):
+    """Compare the vectorized timestamp engine with row-by-row strptime"""
+    agg = Aggregator()
+    # the second format is the one that matches, so the legacy path pays for the failed first attempt
+    formats = ['%d/%m/%Y %H:%M', '%Y-%m-%d %H:%M:%S']
+    data = timestamp_strings(rows, formats[-1])
+    with Timer() as legacy:
+        expected = legacy_parse_timestamps(data, formats)
+    with Timer() as vectorized:
+        result = agg.parse_timestamps(data, formats)
+    assert (pd.to_datetime(expected) == result).all()
+    print 'rows: {0}'.format(rows)
+    print 'legacy:     {0:.3f} s ({1:.0f} rows/s)'.format(legacy.secs, rows / legacy.secs)
+    print 'vectorized: {0:.3f} s ({1:.0f} rows/s)'.format(vectorized.secs, rows / vectorized.secs)
+    print 'speedup:    {0:.1f}x'.format(legacy.secs / vectorized.secs)
+
+@click.command()
+@click.argument('OUTPUT', type=click.Path())
+@click.option('--layout', type=click.Choice(LAYOUTS), default='vliz_2', help='receiver export layout (default: vliz_2)')
+@click.option('--rows', default=100000, help='number of detections (default: 100000)')
+@click.option('--transmitters', default=2000, help='number of distinct transmitters (default: 2000)')
+@click.option('--stations', default=300, help='number of distinct stations (default: 300)')
+@click.option('--seed', default=42)
+def generate(output, layout, rows, transmitters, stations, seed):
+    """Write a synthetic detections file to OUTPUT, and its station mapping next to it"""
+    write_detections(output, layout, rows, transmitters, stations, seed)
+    write_station_mapping(os.path.join(os.path.dirname(os.path.abspath(output)), 'station_names.csv'), stations)
+
+@click.command()
+@click.option('--rows', multiple=True, type=int, help='dataset size, can be repeated (default: 10000, 100000, 1000000)')
+@click.option('--layout', multiple=True, type=click.Choice(LAYOUTS), help='layout to benchmark, can be repeated (default: all)')
+@click.option('--stage', multiple=True, type=click.Choice(STAGES), help='stage to benchmark, can be repeated (default: all)')
+@click.option('--transmitters', default=2000, help='number of distinct transmitters (default: 2000)')
+@click.option('--stations', default=300, help='number of distinct stations (default: 300)')
+@click.option('--seed', default=42)
+@click.option('--workdir', default='./benchmark-data', help='directory for the generated files, reused between runs (default: ./benchmark-data)')
+@click.option('--output', type=click.Path(), help='write the results as JSON to this file')
+def run(rows, layout, stage, transmitters, stations, seed, workdir, output):
+    """Measure throughput and peak memory of the parse and aggregate stages on synthetic data"""
+    results = []
+    for size in rows or [10000, 100000, 1000000]:
+        for stage_name in stage or STAGES:
+            # only parsing depends on the layout of the input file
+            for layout_name in (layout or LAYOUTS) if stage_name == 'parse_detections' else [None]:
+                path, mapping = dataset(workdir, layout_name or 'vliz_2', size, transmitters, stations, seed)
+                queue = Queue()
+                process = Process(target=measure_stage, args=(stage_name, path, mapping, size, transmitters, stations, seed, queue))
+                process.start()
+                process.join()
+                if process.exitcode != 0:
+                    raise click.ClickException('{0} failed on {1} rows'.format(stage_name, size))
+                result = dict(queue.get(), stage=stage_name, layout=layout_name, rows=size)
+                results.append(result)
+                rows_per_sec = '{0:.0f}'.format(result['rows_per_sec']) if result['rows_per_sec'] is not None else '-'
+                click.echo('{stage:<20} {layout:<12} {rows:>10} rows {seconds:>9.3f} s {rows_per_sec:>12} rows/s {peak_rss_mb:>9.1f} MB peak'.format(
+                    **dict(result, layout=layout_name or '-', rows_per_sec=rows_per_sec)), err=True)
+    report = {'environment': environment(), 'transmitters': transmitters, 'stations': stations, 'results': results}
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print json.dumps(report, indent=2)
+
+@click.command()
+@click.argument('BASELINE', type=click.File())
+@click.argument('CURRENT', type=click.File())
+def compare(baseline, current):
+    """Compare two result files written by run"""
+    key = lambda result: (result['stage'], result['layout'], result['rows'])
+    baseline_results = dict((key(result), result) for result in json.load(baseline)['results'])
+    for result in json.load(current)['results']:
+        before = baseline_results.get(key(result))
+        if before is None:
+            continue
+        print '{0:<20} {1:<12} {2:>10} rows  time x{3:.2f}  peak memory x{4:.2f}'.format(
+            result['stage'], result['layout'] or '-', result['rows'],
+            result['seconds'] / before['seconds'], result['peak_rss_mb'] / before['peak_rss_mb'])
+
+benchmark.add_command(timestamps)
+benchmark.add_command(generate)
+benchmark.add_command(run)
+benchmark.add_command(compare)
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,82 @@
+from fish_tracking import StationMapper
+import hashlib
+import os
+import pandas as pd
+
+# bump when the parsed output of parse_detections changes, so older entries are no longer used
+CACHE_VERSION = '1'
+
+class DetectionCache():
+    """
+    On-disk cache of the parsed detections of input files. Entries are keyed by the path, size and modification time of
+    the input file and by the content of the station mapping file, so they are not used any more once either changes.
+    """
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def entry(self, path, station_mapping=None):
+        """Return the file name of the cache entry for path, parsed with station_mapping"""
+        if not isinstance(station_mapping, StationMapper):
+            station_mapping = StationMapper(station_mapping)
+        stat = os.stat(path)
+        path_hash = hashlib.sha1(os.path.abspath(path)).hexdigest()
+        state_hash = hashlib.sha1('\n'.join([
+            CACHE_VERSION,
+            str(stat.st_size),
+            repr(stat.st_mtime),
+            station_mapping.fingerprint
+        ])).hexdigest()
+        return os.path.join(self.directory, '{0}-{1}.pkl'.format(path_hash, state_hash))
+
+    def entries(self):
+        return [os.path.join(self.directory, fname) for fname in os.listdir(self.directory) if fname.endswith('.pkl')]
+
+    def get(self, path, station_mapping=None):
+        """Return the cached detections of path, or None if there is no valid entry"""
+        entry = self.entry(path, station_mapping)
+        if not os.path.exists(entry):
+            return None
+        # mark the entry as recently used for eviction
+        os.utime(entry, None)
+        return pd.read_pickle(entry)
+
+    def put(self, path, station_mapping, detections):
+        entry = self.entry(path, station_mapping)
+        tmp_entry = '{0}.{1}.tmp'.format(entry, os.getpid())
+        detections.to_pickle(tmp_entry)
+        os.rename(tmp_entry, entry)
+        # entries for older versions of the same input file can never be used again
+        path_prefix = os.path.basename(entry).split('-')[0]
+        for other in self.entries():
+            if os.path.basename(other).startswith(path_prefix + '-') and other != entry:
+                os.remove(other)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is no larger than max_size bytes"""
+        if self.max_size is None:
+            return []
+        entries = sorted(self.entries(), key=os.path.getmtime)
+        total = sum(os.path.getsize(entry) for entry in entries)
+        removed = []
+        while entries and total > self.max_size:
+            entry = entries.pop(0)
+            total -= os.path.getsize(entry)
+            os.remove(entry)
+            removed.append(entry)
+        return removed
+
+    def stats(self):
+        entries = self.entries()
+        return {
+            'directory': self.directory,
+            'entries': len(entries),
+            'size': sum(os.path.getsize(entry) for entry in entries),
+            'max_size': self.max_size
+        }
+
+    def clear(self):
+        for entry in self.entries():
+            os.remove(entry)
@@ -0,0 +1,131 @@
+import bz2
+import gzip
+import os
+import threading
+import zipfile
+from Queue import Queue
+
+# compression of detection files by extension; files with these extensions are read without unpacking them first
+COMPRESSIONS = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz', '.zip': 'zip'}
+# bytes decompressed at once, and blocks decompressed ahead of the parser
+BLOCK_SIZE = 1024 * 1024
+PREFETCH_BLOCKS = 8
+
+def compression(path):
+    return COMPRESSIONS.get(os.path.splitext(path)[1].lower())
+
+def is_detection_file(fname):
+    """Whether fname is a csv file, compressed or not, or a zip archive (of a VUE export)"""
+    name = fname.lower()
+    extension = os.path.splitext(name)[1]
+    if extension in COMPRESSIONS:
+        name = name[:-len(extension)]
+    return name.endswith('.csv') or extension == '.zip'
+
+def open_xz(path):
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma
+        except ImportError:
+            raise Exception('xz input needs the backports.lzma package')
+    return lzma.LZMAFile(path, 'rb')
+
+def open_zip_member(path):
+    """Open the csv file in the zip archive path, which should hold exactly one"""
+    archive = zipfile.ZipFile(path)
+    members = [name for name in archive.namelist() if name.lower().endswith('.csv')]
+    if len(members) != 1:
+        raise Exception('{0} should contain one csv file, found {1}'.format(path, len(members)))
+    return archive.open(members[0])
+
+def open_raw(path):
+    kind = compression(path)
+    if kind == 'gzip':
+        return gzip.open(path, 'rb')
+    if kind == 'bz2':
+        return bz2.BZ2File(path, 'rb')
+    if kind == 'xz':
+        return open_xz(path)
+    if kind == 'zip':
+        return open_zip_member(path)
+    return open(path, 'rb')
+
+class PrefetchReader(object):
+    """
+    File-like reader that decompresses a stream on a background thread, up to PREFETCH_BLOCKS blocks ahead of the
+    reads, so decompression overlaps with parsing. Errors of the stream are raised again by read.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.blocks = Queue(maxsize=PREFETCH_BLOCKS)
+        self.buffer = ''
+        self.done = False
+        self.closed = False
+        self.thread = threading.Thread(target=self.prefetch)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def prefetch(self):
+        try:
+            while not self.closed:
+                block = self.stream.read(BLOCK_SIZE)
+                self.blocks.put(block)
+                if not block:
+                    return
+        except Exception as e:
+            self.blocks.put(e)
+
+    def next_block(self):
+        block = self.blocks.get()
+        if isinstance(block, Exception):
+            raise block
+        if not block:
+            self.done = True
+        return block
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            self.buffer += self.next_block()
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self):
+        while not self.done and '\n' not in self.buffer:
+            self.buffer += self.next_block()
+        end = self.buffer.find('\n') + 1 or len(self.buffer)
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        self.closed = True
+        # unblock the prefetch thread if it waits for room in the queue
+        while self.thread.is_alive():
+            while not self.blocks.empty():
+                self.blocks.get()
+            self.thread.join(0.01)
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def open_detections(path):
+    """Open the detections file path for reading, decompressing it on the fly if it is compressed"""
+    if compression(path) is None:
+        return open(path, 'rb')
+    return PrefetchReader(open_raw(path))
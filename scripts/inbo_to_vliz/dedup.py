@@ -0,0 +1,130 @@
+from sharded import load_columns, save_columns
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+# keys kept in memory, over all receivers, before they are spilled to disk
+MAX_KEYS = 10000000
+
+class Deduplicator():
+    """
+    Remove detections that were already seen in another file, keyed on transmitter, receiver and timestamp. Files are
+    compared in the order they are passed to deduplicate, so the first file keeps a detection and later files lose it.
+    Detections that occur twice in the same file are kept.
+
+    With a tolerance of n seconds, timestamps are compared after flooring them to multiples of n seconds. A tolerance
+    of 60 matches the minute-resolution INBO timestamps to the exact ones of the VLIZ exports of the same receiver.
+
+    Only the keys are kept, per receiver: a sorted int64 array of transmitter code and timestamp, and the number of
+    the file each key was first seen in. Duplicates can only come from files of the same receiver, so every file is
+    only searched against the few files of its own receivers. New keys are merged into the sorted keys in memory, and
+    once there are more than max_keys of them, they are spilled to a directory in tmpdir as a sorted run per receiver,
+    which is memory-mapped for the searches. close removes the spilled runs.
+    """
+    def __init__(self, tolerance=0, max_keys=MAX_KEYS, tmpdir=None):
+        self.tolerance = max(int(tolerance), 1)
+        self.max_keys = max_keys
+        self.tmpdir = tmpdir
+        self.workdir = None
+        self.transmitters = pd.Index([], dtype=object)
+        self.seen = {}
+        self.runs = {}
+        self.in_memory = 0
+        self.spilled = 0
+        self.files = []
+        self.file_numbers = {}
+        self.counts = {}
+
+    def file_number(self, path):
+        if path not in self.file_numbers:
+            self.file_numbers[path] = len(self.files)
+            self.files.append(path)
+        return self.file_numbers[path]
+
+    def keys(self, detections):
+        """Return the keys of detections: the transmitter code in the high 32 bits, the timestamp bucket in the low"""
+        timestamps = detections['timestamp'].values
+        if timestamps.dtype.kind == 'M':
+            timestamps = timestamps.view('i8') // 10 ** 9
+        transmitters = detections['transmitter'].astype(object)
+        new_transmitters = pd.Index(transmitters.dropna().unique()).difference(self.transmitters)
+        if len(new_transmitters) > 0:
+            self.transmitters = self.transmitters.append(new_transmitters)
+        codes = self.transmitters.get_indexer(transmitters.values).astype('i8')
+        return (codes << 32) | ((timestamps.astype('i8') // self.tolerance) & 0xffffffff), codes >= 0
+
+    def deduplicate(self, path, detections):
+        """Return detections without the ones seen in other files before. path identifies the file in the report."""
+        number = self.file_number(path)
+        keys, has_transmitter = self.keys(detections)
+        receiver_codes, receivers = pd.factorize(detections['receiver'].astype(object))
+        duplicate = np.zeros(len(detections), dtype=bool)
+        order = np.argsort(receiver_codes, kind='mergesort')
+        bounds = np.searchsorted(receiver_codes[order], np.arange(len(receivers) + 1))
+        for code, receiver in enumerate(receivers):
+            positions = order[bounds[code]:bounds[code + 1]]
+            positions = positions[has_transmitter[positions]]
+            receiver_keys = keys[positions]
+            seen, seen_files = self.lookup(receiver, receiver_keys)
+            found = seen & (seen_files != number)
+            duplicate[positions[found]] = True
+            for other, count in zip(*np.unique(seen_files[found], return_counts=True)):
+                pair = (path, self.files[other])
+                self.counts[pair] = self.counts.get(pair, 0) + count
+            self.insert(receiver, np.unique(receiver_keys[~seen]), number)
+        if self.in_memory > self.max_keys:
+            self.spill()
+        return detections[~duplicate]
+
+    def lookup(self, receiver, keys):
+        """Return whether each of keys was seen for receiver, and the number of the file it was first seen in"""
+        seen = np.zeros(len(keys), dtype=bool)
+        files = np.zeros(len(keys), dtype='i8')
+        runs = self.runs.get(receiver, []) + ([self.seen[receiver]] if receiver in self.seen else [])
+        for run_keys, run_files in runs:
+            index = np.minimum(np.searchsorted(run_keys, keys), len(run_keys) - 1)
+            found = run_keys[index] == keys
+            seen |= found
+            files[found] = run_files[index[found]]
+        return seen, files
+
+    def insert(self, receiver, new_keys, number):
+        """Merge new_keys, sorted and not seen before, of file number into the sorted keys in memory of receiver"""
+        if len(new_keys) == 0:
+            return
+        seen_keys, seen_files = self.seen.get(receiver, (np.array([], dtype='i8'), np.array([], dtype='i8')))
+        index = np.searchsorted(seen_keys, new_keys)
+        self.seen[receiver] = (np.insert(seen_keys, index, new_keys), np.insert(seen_files, index, number))
+        self.in_memory += len(new_keys)
+
+    def spill(self):
+        """Write the keys in memory to disk as a sorted run per receiver and search them memory-mapped from now on"""
+        if self.workdir is None:
+            self.workdir = tempfile.mkdtemp(prefix='ft-dedup-', dir=self.tmpdir)
+        for receiver, (keys, files) in self.seen.items():
+            path = os.path.join(self.workdir, 'run-{0:06d}'.format(self.spilled))
+            save_columns(path, {'keys': keys, 'files': files})
+            run = load_columns(path)
+            self.runs.setdefault(receiver, []).append((run['keys'], run['files']))
+            self.spilled += 1
+        self.seen = {}
+        self.in_memory = 0
+
+    def close(self):
+        if self.workdir is not None:
+            shutil.rmtree(self.workdir)
+            self.workdir = None
+
+    def removed(self):
+        return sum(self.counts.values())
+
+    def report(self):
+        """Return the number of duplicates removed from each file, per file they duplicated"""
+        pairs = sorted(self.counts.items())
+        return pd.DataFrame(data={
+            'file': [os.path.basename(path) for (path, other), count in pairs],
+            'duplicate_of': [os.path.basename(other) for (path, other), count in pairs],
+            'duplicates': [count for pair, count in pairs]
+        }, columns=['file', 'duplicate_of', 'duplicates'])
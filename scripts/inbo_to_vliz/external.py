@@ -0,0 +1,144 @@
+from fish_tracking import timestamps_ns
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+# detections without a station name still end an interval, like NaN does in Aggregator.intervals
+NO_STATION = ''
+# rows per block that is read from a run during the merge
+BLOCK_SIZE = 50000
+# runs merged at once; with more runs, groups of runs are merged into longer runs first
+MAX_FANIN = 32
+
+class SortedRun():
+    """Detections sorted by transmitter and timestamp, stored on disk in blocks"""
+    def __init__(self, directory):
+        self.directory = directory
+        self.blocks = 0
+        os.makedirs(directory)
+
+    @classmethod
+    def write(cls, agg, detections, directory, block_size=None):
+        """Sort detections and write them as a new run"""
+        detections = detections[detections['transmitter'].notnull()]
+        detections = pd.DataFrame(data={
+            'timestamp': timestamps_ns(detections).view('i8'),
+            'transmitter': detections['transmitter'].astype(object).values,
+            'stationname': detections['stationname'].astype(object).fillna(NO_STATION).values
+        })
+        run = cls(directory)
+        run.append(agg.sort_detections(detections), block_size)
+        return run
+
+    def append(self, detections, block_size=None):
+        """Add detections that sort after everything in the run so far"""
+        block_size = block_size or BLOCK_SIZE
+        for start in range(0, len(detections), block_size):
+            detections.iloc[start:start + block_size].to_pickle(self.block_file(self.blocks))
+            self.blocks += 1
+
+    def block_file(self, number):
+        return os.path.join(self.directory, 'block-{0:06d}.pkl'.format(number))
+
+    def __iter__(self):
+        for number in range(self.blocks):
+            yield pd.read_pickle(self.block_file(number))
+
+def upto(block, transmitter, timestamp):
+    """Return a boolean mask of the rows of block that sort before or at (transmitter, timestamp)"""
+    transmitters = block['transmitter'].values
+    return (transmitters < transmitter) | ((transmitters == transmitter) & (block['timestamp'].values <= timestamp))
+
+def merge_runs(agg, runs):
+    """
+    Merge sorted runs into one stream of detections sorted by transmitter and timestamp. Only one block per run is in
+    memory: every step emits all buffered rows up to the smallest last key of the buffers, which no unread row can
+    precede, so at least one buffer is used up and read again from its run.
+    """
+    readers = [iter(run) for run in runs]
+    buffers = [next(reader, None) for reader in readers]
+    while True:
+        active = [i for i, block in enumerate(buffers) if block is not None]
+        if not active:
+            return
+        bound = min((buffers[i]['transmitter'].values[-1], buffers[i]['timestamp'].values[-1]) for i in active)
+        taken = []
+        for i in active:
+            mask = upto(buffers[i], *bound)
+            taken.append(buffers[i][mask])
+            buffers[i] = buffers[i][~mask]
+            if len(buffers[i]) == 0:
+                buffers[i] = next(readers[i], None)
+        # runs are concatenated in input order and sorted stably, so ties keep the order of a full sort
+        yield agg.sort_detections(pd.concat(taken))
+
+def build_intervals(agg, sorted_chunks, minutes_delta=30):
+    """
+    Aggregate a stream of detection chunks, sorted by transmitter and timestamp across chunks, into intervals. The
+    last interval of a chunk may continue in the next one, so it is held back until the next chunk shows it is closed.
+    """
+    open_interval = None
+    max_gap = np.timedelta64(minutes_delta * 60, 's')
+    for chunk in sorted_chunks:
+        chunk = chunk.assign(timestamp=chunk['timestamp'].values.astype('datetime64[ns]'))
+        intervals = agg.intervals(chunk, minutes_delta=minutes_delta)
+        if len(intervals) == 0:
+            continue
+        if open_interval is not None:
+            first = intervals.iloc[0]
+            last = open_interval.iloc[0]
+            if (first['transmitter'] == last['transmitter'] and first['stationname'] == last['stationname'] and
+                    first['start'] - last['stop'] < max_gap):
+                intervals.loc[intervals.index[0], 'start'] = last['start']
+            else:
+                intervals = pd.concat([open_interval, intervals])
+        open_interval = intervals.iloc[-1:]
+        closed = intervals.iloc[:-1]
+        yield closed[closed['stationname'] != NO_STATION]
+    if open_interval is not None:
+        yield open_interval[open_interval['stationname'] != NO_STATION]
+
+def external_aggregate(agg, paths, station_mapping=None, minutes_delta=30, chunksize=1000000, tmpdir=None, deduplicator=None,
+                       on_error=None):
+    """
+    Aggregate the detections in paths with bounded memory. Every file is parsed in chunks of chunksize rows, which are
+    sorted and written to disk as runs. The runs are merged and aggregated as a stream. Yields DataFrames of intervals
+    in the order Aggregator.aggregate returns them. Detections that deduplicator has seen in another file are dropped
+    before they are written. A file that can not be parsed is left out and passed to on_error with the exception if
+    it is given, otherwise the exception is raised.
+    """
+    workdir = tempfile.mkdtemp(prefix='ft-runs-', dir=tmpdir)
+    try:
+        runs = []
+        for path in paths:
+            first_run = len(runs)
+            try:
+                for chunk in agg.iter_detections(path, station_mapping=station_mapping, chunksize=chunksize):
+                    if deduplicator is not None:
+                        chunk = deduplicator.deduplicate(path, chunk)
+                    runs.append(SortedRun.write(agg, chunk, os.path.join(workdir, 'run-{0:06d}'.format(len(runs)))))
+            except Exception as e:
+                if on_error is None:
+                    raise
+                # the runs of the chunks parsed before the error
+                for run in runs[first_run:]:
+                    shutil.rmtree(run.directory)
+                del runs[first_run:]
+                on_error(path, e)
+        while len(runs) > MAX_FANIN:
+            merged = []
+            for start in range(0, len(runs), MAX_FANIN):
+                run = SortedRun(os.path.join(workdir, 'merged-{0:06d}-{1:06d}'.format(len(runs), start)))
+                for detections in merge_runs(agg, runs[start:start + MAX_FANIN]):
+                    run.append(detections)
+                merged.append(run)
+            for run in runs:
+                shutil.rmtree(run.directory)
+            runs = merged
+        for intervals in build_intervals(agg, merge_runs(agg, runs), minutes_delta=minutes_delta):
+            if len(intervals) > 0:
+                yield intervals
+    finally:
+        shutil.rmtree(workdir)
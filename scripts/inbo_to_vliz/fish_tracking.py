@@ -1,158 +1,286 @@
+import csv
+import hashlib
+import numpy as np
 import pandas as pd
-import re
-from datetime import datetime, timedelta
+import sys
+from datetime import datetime
 from time import strptime
+from pandas.api.types import is_categorical_dtype
+from timer import Metrics
+from compressed import open_detections
+
+# Timestamp layouts found in receiver exports. Each layout comes with the
+# pattern a value has to match completely before it is handed to pandas.
+TIMESTAMP_PATTERNS = {
+    '%Y-%m-%d %H:%M:%S': r'^\d{4}-\d{1,2}-\d{1,2} \d{1,2}:\d{1,2}:\d{1,2}$',
+    '%d/%m/%Y %H:%M:%S': r'^\d{1,2}/\d{1,2}/\d{4} \d{1,2}:\d{1,2}:\d{1,2}$',
+    '%d/%m/%Y %H:%M': r'^\d{1,2}/\d{1,2}/\d{4} \d{1,2}:\d{1,2}$'
+}
+TIMESTAMP_SAMPLE_SIZE = 100
+STATION_NAME_PATTERN = '^[a-zA-Z]+-[0-9a-zA-Z]+$'
+REJECT_COLUMNS = ['file', 'line', 'reason', 'timestamp', 'transmitter', 'stationname', 'receiver']
+
+class DetectionFormat():
+    """
+    Layout of a receiver export. Files are recognized by their header columns; only usecols are read, with the given
+    dtypes, and the resulting DataFrame is handed to parser(aggregator, dataframe, station_mapping=None).
+    """
+    def __init__(self, name, columns, usecols, dtype, parser):
+        self.name = name
+        self.columns = columns
+        self.usecols = usecols
+        self.dtype = dtype
+        self.parser = parser
+
+# registered formats, keyed on their sorted header columns
+DETECTION_FORMATS = {}
+
+def register_format(detection_format):
+    DETECTION_FORMATS[tuple(sorted(detection_format.columns))] = detection_format
+
+class StationMapper():
+    """Station name mapping file, compiled once into a lookup table of old names and receiver ids"""
+    def __init__(self, station_mapping=None):
+        self.station_mapping = station_mapping
+        self.lookup = {}
+        self.validity = {}
+        self.fingerprint = ''
+        if station_mapping:
+            with open(station_mapping, 'rb') as f:
+                self.fingerprint = hashlib.sha1(f.read()).hexdigest()
+            stations = pd.read_csv(station_mapping, header=0, dtype=str)
+            stations['old_name'].fillna(stations['receiver_id'][stations['old_name'].isnull()], inplace=True)
+            new_names = [str(x).strip() for x in stations['new_name']]
+            # old names are replaced first, receiver ids second, and each replacement sees the result of the
+            # previous ones. Walking the pairs backwards resolves such chains once, here, instead of for every value.
+            pairs = zip([str(x).strip() for x in stations['old_name']], new_names)
+            pairs += zip([str(x).strip() for x in stations['receiver_id']], new_names)
+            for old, new in reversed(pairs):
+                self.lookup[old] = self.lookup.get(new, new)
+
+    def map(self, inseries):
+        if not self.lookup:
+            return inseries
+        names = inseries.dropna().unique()
+        mapped = pd.Series([self.lookup.get(name, name) for name in names], index=names)
+        return inseries.map(mapped)
+
+    def valid(self, inseries):
+        """Return a boolean mask of the station names in inseries that have the required format"""
+        names = inseries.dropna().unique()
+        unseen = pd.Series([name for name in names if name not in self.validity])
+        if len(unseen) > 0:
+            matches = unseen.astype(str).str.match(STATION_NAME_PATTERN)
+            self.validity.update(zip(unseen, matches))
+        # missing station names are never valid
+        valid = inseries.map(pd.Series([self.validity[name] for name in names], index=names))
+        return valid.fillna(False).astype(bool)
+
+def timestamps_ns(detections):
+    """Return the timestamps of detections as datetime64[ns], also if they are compacted to epoch seconds"""
+    timestamps = detections['timestamp'].values
+    if timestamps.dtype.kind == 'i':
+        return (timestamps * 10 ** 9).astype('datetime64[ns]')
+    return timestamps
 
 class Aggregator():
-    def __init__(self, logging=False):
+    def __init__(self, logging=False, compact=False, metrics=None, isolation_window=None, quarantine=False):
         self.logging = logging
+        self.compact = compact
+        self.metrics = metrics or Metrics()
+        # seconds within which a detection needs another one of its transmitter at its station, if given
+        self.isolation_window = isolation_window
+        self.isolated_removed = 0
+        # with quarantine, invalid rows are collected in rejected instead of failing their file
+        self.quarantine = quarantine
+        self.rejected = []
+        self.station_mappers = {}
+        # categories of compacted detections, shared across files
+        self.dictionaries = {}
 
-    def unix_time(self, dt):
-        epoch = datetime.utcfromtimestamp(0)
-        delta = dt - epoch
-        return int(delta.total_seconds())
-
-    def parse_detections(self, infile, station_mapping=None):
-        vliz_cols = [
-            'Date(UTC)',
-            'Time(UTC)',
-            'Receiver',
-            'Transmitter',
-            'TransmitterName',
-            'TransmitterSerial',
-            'SensorValue',
-            'SensorUnit',
-            'StationName',
-            'Latitude',
-            'Longitude'
-        ]
-        vliz_2_cols = [
-            'Date and Time (UTC)',
-            'Receiver',
-            'Transmitter',
-            'Transmitter Name',
-            'Transmitter Serial',
-            'Sensor Value',
-            'Sensor Unit',
-            'Station Name',
-            'Latitude',
-            'Longitude'
-        ]
-        inbo_cols = [
-            'Date/Time',
-            'Code Space',
-            'ID',
-            'Sensor 1',
-            'Units 1',
-            'Sensor 2',
-            'Units 2',
-            'Transmitter Name',
-            'Transmitter S/N',
-            'Receiver Name',
-            'Receiver S/N',
-            'Station Name',
-            'Station Latitude',
-            'Station Longitude'
-        ]
-        vue_export_cols = [
-            'date_time_utc',
-            'receiver_id',
-            'transmitter_id',
-            'old_station_name',
-            'station_name',
-            'latitude',
-            'longitude'
-        ]
-        if self.logging:
-            print '{0} AGGREGATOR: reading file'.format(datetime.now().isoformat())
-        df = pd.read_csv(infile, encoding='utf-8-sig')
-        if len(df.columns) is 1:
-            df = pd.read_csv(infile, sep='\t', encoding='utf-8-sig')
+    def log(self, message):
+        """Write a progress message to stderr, so it does not end up in the csv on stdout"""
         if self.logging:
-            print '{0} AGGREGATOR: parsing file'.format(datetime.now().isoformat())
-        if len(df.columns) is len(vliz_cols):
-            if sorted(list(df.columns)) == sorted(vliz_cols):
-                return self.parse_vliz_detections(df, station_mapping=station_mapping)
-        if len(df.columns) is len(vliz_2_cols):
-            if sorted(list(df.columns)) == sorted(vliz_2_cols):
-                return self.parse_vliz_2_detections(df, station_mapping=station_mapping)
-        if len(df.columns) is len(inbo_cols):
-            if sorted(list(df.columns)) == sorted(inbo_cols):
-                return self.parse_inbo_detections(df, station_mapping=station_mapping)
-        if len(df.columns) is len(vue_export_cols):
-            if sorted(list(df.columns)) == sorted(vue_export_cols):
-                return self.parse_vue_export_detections(df, station_mapping=station_mapping)
+            sys.stderr.write('{0} AGGREGATOR: {1}\n'.format(datetime.now().isoformat(), message))
+
+    def detect_timestamp_format(self, inseries, formats):
+        """Return the format that parses most of a sample of inseries"""
+        sample = inseries.dropna().head(TIMESTAMP_SAMPLE_SIZE)
+        best_format, best_count = None, 0
+        for fmt in formats:
+            count = 0
+            for value in sample:
+                try:
+                    strptime(value, fmt)
+                    count += 1
+                except (ValueError, TypeError):
+                    pass
+            if count > best_count:
+                best_format, best_count = fmt, count
+        if best_format is None:
+            raise Exception('Timestamps do not match any of the formats {0}'.format(', '.join(formats)))
+        return best_format
+
+    def parse_timestamps(self, inseries, formats):
+        """Convert a column of timestamp strings to datetime64 in a single pass"""
+        with self.metrics.stage('parse_timestamps', rows_in=len(inseries)) as stage:
+            fmt = self.detect_timestamp_format(inseries, formats)
+            values = inseries.astype(str)
+            timestamps = pd.to_datetime(values, format=fmt, errors='coerce')
+            invalid = timestamps.isnull() | ~values.str.match(TIMESTAMP_PATTERNS[fmt])
+            stage.rows_out = len(timestamps)
+        if invalid.any():
+            first = invalid.idxmax()
+            message = '{0} timestamps do not match format {1}, e.g. row {2}: \'{3}\''.format(
+                invalid.sum(), fmt, first, inseries[first])
+            if not self.quarantine:
+                raise Exception(message)
+            self.log(message)
+            timestamps[invalid] = pd.NaT
+        return timestamps
+
+    def sniff_format(self, infile):
+        """Detect delimiter and layout of infile from its header line. Returns the delimiter and the DetectionFormat."""
+        with open_detections(infile) as f:
+            header = f.readline().decode('utf-8-sig').encode('utf-8').rstrip('\r\n')
+        for sep in [',', '\t']:
+            columns = tuple(sorted(next(csv.reader([header], delimiter=sep))))
+            if columns in DETECTION_FORMATS:
+                return sep, DETECTION_FORMATS[columns]
         raise Exception('Unknown input format for {0}'.format(infile))
 
+    def read_csv_options(self, sep, detection_format):
+        return dict(sep=sep, encoding='utf-8-sig', usecols=detection_format.usecols, dtype=detection_format.dtype)
+
+    def parse_detections(self, infile, station_mapping=None):
+        sep, detection_format = self.sniff_format(infile)
+        self.log('reading {0} file'.format(detection_format.name))
+        with self.metrics.stage('read') as stage, open_detections(infile) as f:
+            df = pd.read_csv(f, **self.read_csv_options(sep, detection_format))
+            stage.rows_out = len(df)
+        self.log('parsing file')
+        return self.quarantine_rows(infile, detection_format.parser(self, df, station_mapping=station_mapping))
+
+    def iter_detections(self, infile, station_mapping=None, chunksize=100000):
+        """Like parse_detections, but read infile in chunks of chunksize rows and yield the parsed chunks"""
+        sep, detection_format = self.sniff_format(infile)
+        with open_detections(infile) as f:
+            reader = pd.read_csv(f, chunksize=chunksize, **self.read_csv_options(sep, detection_format))
+            while True:
+                with self.metrics.stage('read') as stage:
+                    chunk = next(reader, None)
+                    stage.rows_out = len(chunk) if chunk is not None else 0
+                if chunk is None:
+                    return
+                self.log('parsing chunk of {0} rows'.format(len(chunk)))
+                yield self.quarantine_rows(infile, detection_format.parser(self, chunk, station_mapping=station_mapping))
+
+    def quarantine_rows(self, infile, detections):
+        """
+        With quarantine, move the rows without a valid timestamp, station name or transmitter from detections to
+        rejected, with the file and line they come from and the reasons, and return the other rows. The line is the
+        number of the row in the file counting the header as line 1, so it assumes there are no blank lines.
+        """
+        if not self.quarantine:
+            return detections
+        with self.metrics.stage('quarantine', rows_in=len(detections)) as stage:
+            checks = [
+                ('invalid timestamp', detections['timestamp'].isnull().values),
+                ('invalid station name', ~self.station_mapper(None).valid(detections['stationname']).values),
+                ('missing transmitter', detections['transmitter'].isnull().values)
+            ]
+            invalid = np.zeros(len(detections), dtype=bool)
+            for reason, failed in checks:
+                invalid |= failed
+            if invalid.any():
+                reasons = pd.Series('', index=detections.index[invalid])
+                for reason, failed in checks:
+                    reasons += np.where(failed[invalid], '; ' + reason, '')
+                rejected = detections[invalid].assign(
+                    file=infile, line=detections.index[invalid] + 2, reason=reasons.str[2:])
+                self.rejected.append(rejected[[column for column in REJECT_COLUMNS if column in rejected]])
+                detections = detections[~invalid]
+            stage.rows_out = len(detections)
+        return detections
+
+    def rejected_rows(self):
+        """Return the rows rejected by quarantine_rows so far"""
+        if not self.rejected:
+            return pd.DataFrame(columns=REJECT_COLUMNS)
+        return pd.concat(self.rejected, ignore_index=True)
+
+    def station_mapper(self, station_mapping):
+        """Return the StationMapper for station_mapping, which is either a StationMapper or the path of a mapping file"""
+        if isinstance(station_mapping, StationMapper):
+            return station_mapping
+        if station_mapping not in self.station_mappers:
+            self.station_mappers[station_mapping] = StationMapper(station_mapping)
+        return self.station_mappers[station_mapping]
+
+    def map_stationnames(self, inseries, station_mapping):
+        self.log('inseries data type: {0}'.format(inseries.dtype))
+        with self.metrics.stage('map_stationnames', rows_in=len(inseries)) as stage:
+            mapped = self.station_mapper(station_mapping).map(inseries)
+            stage.rows_out = len(mapped)
+        return mapped
+
+    def valid_stationnames(self, inseries):
+        with self.metrics.stage('validate_stationnames', rows_in=len(inseries)) as stage:
+            wrong_station_names = inseries[~self.station_mapper(None).valid(inseries)]
+            stage.rows_out = len(inseries) - len(wrong_station_names)
+        if len(wrong_station_names) > 0:
+            self.log('{0} wrong station names: \'{1}\''.format(len(wrong_station_names), str(wrong_station_names.unique())))
+        return len(wrong_station_names) == 0
+
     def check_stationnames(self, inseries, station_mapping):
-        if self.logging:
-            print '{0} AGGREGATOR: inseries data type: {1}'.format(datetime.now().isoformat(), inseries.dtype)
+        """Map the station names in inseries in place and return whether they all have the required format"""
         if station_mapping:
-            stations = pd.read_csv(station_mapping, header=0)
-            stations['old_name'].fillna(stations['receiver_id'][stations['old_name'].isnull()], inplace=True)
-            inseries.replace(
-                to_replace=list(stations['old_name'].apply(lambda x: str(x).strip())),
-                value=list(stations['new_name'].apply(lambda x: str(x).strip())),
-                inplace=True
-            )
-            inseries.replace(
-                to_replace=list(stations['receiver_id'].apply(lambda x: str(x).strip())),
-                value=list(stations['new_name'].apply(lambda x: str(x).strip())),
-                inplace=True
-            )
-        wrong_station_names = inseries[inseries.apply(lambda x: False if re.search('^[a-zA-Z]+-[0-9a-zA-Z]+$', str(x)) else True)]
-        if self.logging:
-            if len(wrong_station_names) > 0:
-                print '{0} wrong station names: \'{1}\''.format(len(wrong_station_names), str(wrong_station_names.unique()))
-        return len(wrong_station_names) == 0
+            inseries[:] = self.map_stationnames(inseries, station_mapping)
+        return self.valid_stationnames(inseries)
 
     def parse_vliz_detections(self, dataframe, station_mapping=None):
         timestamps_str = dataframe['Date(UTC)'] + ' ' + dataframe['Time(UTC)']
-        try:
-            timestamps = timestamps_str.apply(lambda x: datetime(*strptime(x, '%Y-%m-%d %H:%M:%S')[:6]))
-        except:
-            timestamps = timestamps_str.apply(lambda x: datetime(*strptime(x, '%d/%m/%Y %H:%M:%S')[:6]))
+        timestamps = self.parse_timestamps(timestamps_str, ['%Y-%m-%d %H:%M:%S', '%d/%m/%Y %H:%M:%S'])
         # check station name format
         # first cast to string. If original series was not a string (because data was absent) NaN will be replaced by 'nan'. We'll explicitly replace those too.
         dataframe['Station Name'] = dataframe['StationName'].astype(str).replace(to_replace=['nan'], value=[None])
         # Now, where the StationName is empty (None or NaN instead of 'nan'), replace it by the Receiver
         dataframe['StationName'].fillna(dataframe['Receiver'][dataframe['StationName'].isnull()], inplace=True) # fill in empty station names with receiver ids
-        if not self.check_stationnames(dataframe['StationName'], station_mapping):
+        stationnames = self.map_stationnames(dataframe['StationName'], station_mapping)
+        if not self.quarantine and not self.valid_stationnames(stationnames):
             raise Exception('StationName found that does not match required format')
         outdf = pd.DataFrame(
             data={
                 'timestamp': timestamps,
                 'transmitter': dataframe['Transmitter'],
-                'stationname': dataframe['StationName'],
+                'stationname': stationnames,
                 'receiver': dataframe['Receiver']
             }
         )
         return outdf
 
     def parse_vliz_2_detections(self, dataframe, station_mapping=None):
-        timestamps = dataframe['Date and Time (UTC)'].apply(lambda x: datetime(*strptime(x, '%Y-%m-%d %H:%M:%S')[:6]))
+        timestamps = self.parse_timestamps(dataframe['Date and Time (UTC)'], ['%Y-%m-%d %H:%M:%S'])
         # check station name format
         # first cast to string. If original series was not a string (because data was absent) NaN will be replaced by 'nan'. We'll explicitly replace those too.
         dataframe['Station Name'] = dataframe['Station Name'].astype(str).replace(to_replace=['nan'], value=[None])
         # Now, where the StationName is empty (None or NaN instead of 'nan'), replace it by the Receiver
         dataframe['Station Name'].fillna(dataframe['Receiver'][dataframe['Station Name'].isnull()], inplace=True) # fill in empty station names with receiver ids
-        if not self.check_stationnames(dataframe['Station Name'], station_mapping):
+        stationnames = self.map_stationnames(dataframe['Station Name'], station_mapping)
+        if not self.quarantine and not self.valid_stationnames(stationnames):
             raise Exception('Station Name found that does not match required format')
         outdf = pd.DataFrame(
             data={
                 'timestamp': timestamps,
                 'transmitter': dataframe['Transmitter'],
-                'stationname': dataframe['Station Name'],
+                'stationname': stationnames,
                 'receiver': dataframe['Receiver']
             }
         )
         return outdf
 
     def parse_inbo_detections(self, dataframe, station_mapping=None):
-        try:
-            timestamps = dataframe['Date/Time'].apply(lambda x: datetime(*strptime(x, '%d/%m/%Y %H:%M')[:6]))
-        except:
-            timestamps = dataframe['Date/Time'].apply(lambda x: datetime(*strptime(x, '%Y-%m-%d %H:%M:%S')[:6]))
+        timestamps = self.parse_timestamps(dataframe['Date/Time'], ['%d/%m/%Y %H:%M', '%Y-%m-%d %H:%M:%S'])
         transmitters = dataframe['Code Space'] + '-' + dataframe['ID'].apply(str)
         # first cast to string. If original series was not a string (because data was absent) NaN will be replaced by 'nan'. We'll explicitly replace those too.
         dataframe['Station Name'] = dataframe['Station Name'].astype(str).replace(to_replace=['nan'], value=[None])
@@ -160,69 +288,338 @@ class Aggregator():
         dataframe['Station Name'].fillna(dataframe['Receiver Name'][dataframe['Station Name'].isnull()], inplace=True) # fill in empty station names with receiver names
         # Or.. if that doesn't work, replace it with the Receiver serial number
         dataframe['Station Name'].fillna(dataframe['Receiver S/N'][dataframe['Station Name'].isnull()], inplace=True) # fill in empty station names with receiver serial number
-        if not self.check_stationnames(dataframe['Station Name'], station_mapping):
+        stationnames = self.map_stationnames(dataframe['Station Name'], station_mapping)
+        if not self.quarantine and not self.valid_stationnames(stationnames):
             raise Exception('Station Name found that does not match required format')
         outdf = pd.DataFrame(
             data={
                 'timestamp': timestamps,
                 'transmitter': transmitters,
-                'stationname': dataframe['Station Name'],
+                'stationname': stationnames,
                 'receiver': dataframe['Receiver Name']
             }
         )
         return outdf
 
     def parse_vue_export_detections(self, dataframe, station_mapping=None):
-        try:
-            timestamps = dataframe['date_time_utc'].apply(lambda x: datetime(*strptime(x, '%d/%m/%Y %H:%M')[:6]))
-        except:
-            timestamps = dataframe['date_time_utc'].apply(lambda x: datetime(*strptime(x, '%Y-%m-%d %H:%M:%S')[:6]))
+        timestamps = self.parse_timestamps(dataframe['date_time_utc'], ['%d/%m/%Y %H:%M', '%Y-%m-%d %H:%M:%S'])
         # first cast to string. If original series was not a string (because data was absent) NaN will be replaced by 'nan'. We'll explicitly replace those too.
         dataframe['station_name'] = dataframe['station_name'].astype(str).replace(to_replace=['nan'], value=[None])
         # Now, where the StationName is empty (None or NaN instead of 'nan'), replace it by the Receiver
         dataframe['station_name'].fillna(dataframe['receiver_id'][dataframe['station_name'].isnull()], inplace=True) # fill in empty station names with receiver ids
-        if not self.check_stationnames(dataframe['station_name'], station_mapping):
+        stationnames = self.map_stationnames(dataframe['station_name'], station_mapping)
+        if not self.quarantine and not self.valid_stationnames(stationnames):
             raise Exception('station_name found that does not match required format')
         outdf = pd.DataFrame(
             data={
                 'timestamp': timestamps,
                 'transmitter': dataframe['transmitter_id'],
-                'stationname': dataframe['station_name'],
+                'stationname': stationnames,
                 'receiver': dataframe['receiver_id']
             }
         )
         return outdf
 
 
+    def codes(self, values):
+        """Values to compare for equality: the codes of a categorical, or the values themselves"""
+        if isinstance(values, pd.Categorical):
+            # missing values get code -1, but should differ from each other like NaN does
+            codes = values.codes.astype('i8')
+            missing = codes < 0
+            codes[missing] = -1 - np.flatnonzero(missing)
+            return codes
+        return values
+
+    def compact_detections(self, detections):
+        """
+        Return detections with epoch seconds as int64 timestamps and categorical transmitter, stationname and
+        receiver. The categories come from dictionaries shared by all detections compacted by this Aggregator.
+        """
+        compacted = pd.DataFrame(index=detections.index)
+        timestamps = detections['timestamp'].values
+        if timestamps.dtype.kind == 'M':
+            timestamps = timestamps.view('i8') // 10 ** 9
+        compacted['timestamp'] = timestamps
+        for column in ['receiver', 'stationname', 'transmitter']:
+            if column not in detections:
+                continue
+            values = detections[column]
+            if str(values.dtype) == 'category':
+                values = values.astype(object)
+            dictionary = self.dictionaries.get(column, pd.Index([], dtype=object))
+            new_values = pd.Index(values.dropna().unique()).difference(dictionary)
+            if len(new_values) > 0:
+                dictionary = dictionary.append(new_values)
+                self.dictionaries[column] = dictionary
+            compacted[column] = pd.Categorical(values, categories=dictionary)
+        return compacted
+
+    def concat_detections(self, frames):
+        """
+        Concatenate detections. Categorical columns get the union of the categories of all frames first, so they stay
+        categorical instead of falling back to object.
+        """
+        frames = list(frames)
+        for column in ['receiver', 'stationname', 'transmitter']:
+            if not frames or not all(column in frame and str(frame[column].dtype) == 'category' for frame in frames):
+                continue
+            categories = frames[0][column].cat.categories
+            for frame in frames[1:]:
+                other = frame[column].cat.categories
+                if not other.equals(categories):
+                    categories = categories.append(other.difference(categories))
+            for frame in frames:
+                if not frame[column].cat.categories.equals(categories):
+                    frame[column] = frame[column].cat.set_categories(categories)
+        return pd.concat(frames)
+
+    def memory_report(self, detections):
+        """Return the memory used by each column of detections, in bytes in total and per row"""
+        usage = detections.memory_usage(index=True, deep=True)
+        report = pd.DataFrame(data={
+            'dtype': [str(detections.index.dtype)] + [str(dtype) for dtype in detections.dtypes],
+            'bytes': usage.values,
+            'bytes_per_row': usage.values / float(max(len(detections), 1))
+        }, index=usage.index, columns=['dtype', 'bytes', 'bytes_per_row'])
+        report.loc['total'] = ['', report['bytes'].sum(), report['bytes_per_row'].sum()]
+        return report
+
+    def sort_order(self, transmitters, timestamps):
+        """Return the positions that sort by transmitter and timestamp"""
+        if is_categorical_dtype(transmitters):
+            # the categories of compacted detections are in the order they were first seen, so rank them by name
+            categorical = pd.Categorical(transmitters)
+            ranks = np.empty(len(categorical.categories) + 1, dtype='i8')
+            ranks[np.argsort(categorical.categories.values, kind='mergesort')] = np.arange(len(categorical.categories))
+            ranks[-1] = len(categorical.categories)
+            codes = ranks[categorical.codes]
+        else:
+            codes, uniques = pd.factorize(transmitters, sort=True)
+            codes[codes < 0] = len(uniques) # missing transmitters go last, as with DataFrame.sort
+        return np.lexsort((timestamps.view('i8'), codes))
+
+    def sort_detections(self, indata):
+        """Sort detections by transmitter and timestamp, using integer keys instead of comparing strings"""
+        with self.metrics.stage('sort', rows_in=len(indata)) as stage:
+            sorted_data = indata.take(self.sort_order(indata['transmitter'], indata['timestamp'].values))
+            stage.rows_out = len(sorted_data)
+        return sorted_data
+
+    def interval_gaps(self, sorted_data):
+        """
+        Return the time from every detection in detections sorted by sort_detections to the next one, in int64 units
+        of its timestamps, and the largest int64 where the transmitter or station changes, so a gap at least
+        minutes_delta long ends an interval for any minutes_delta
+        """
+        timestamps = sorted_data['timestamp'].values
+        transmitters = sorted_data['transmitter'].values
+        stationnames = sorted_data['stationname'].values
+        gaps = timestamps[1:].view('i8') - timestamps[:-1].view('i8')
+        if timestamps.dtype.kind == 'M':
+            # like comparisons with NaT, a missing timestamp does not end an interval
+            missing = timestamps.view('i8') == np.iinfo('i8').min
+            gaps[missing[1:] | missing[:-1]] = 0
+        changes = (
+            (self.codes(transmitters[1:]) != self.codes(transmitters[:-1])) |
+            (self.codes(stationnames[1:]) != self.codes(stationnames[:-1]))
+        )
+        gaps[changes] = np.iinfo('i8').max
+        return gaps
+
+    def intervals(self, sorted_data, minutes_delta=30, gaps=None):
+        """
+        Return start, stop, transmitter and stationname of each interval in detections sorted by sort_detections.
+        gaps, as returned by interval_gaps, can be passed when the intervals are computed for several minutes_delta.
+        """
+        with self.metrics.stage('group', rows_in=len(sorted_data)) as stage:
+            timestamps = sorted_data['timestamp'].values
+            transmitters = sorted_data['transmitter'].values
+            stationnames = sorted_data['stationname'].values
+            if gaps is None:
+                gaps = self.interval_gaps(sorted_data)
+            # compact detections have epoch seconds, others datetime64[ns]
+            max_gap = minutes_delta * 60 * (10 ** 9 if timestamps.dtype.kind == 'M' else 1)
+            # an interval ends at a gap of minutes_delta or more and wherever the transmitter or station changes
+            boundaries = gaps >= max_gap
+            is_first = np.ones(len(timestamps), dtype=bool)
+            is_first[1:] = boundaries
+            is_last = np.ones(len(timestamps), dtype=bool)
+            is_last[:-1] = boundaries
+            first = np.flatnonzero(is_first)
+            last = np.flatnonzero(is_last)
+            timestamps = timestamps_ns(sorted_data)
+            outdf = pd.DataFrame(data={
+                'start': timestamps[first],
+                'stop': timestamps[last],
+                'transmitter': transmitters[first],
+                'stationname': stationnames[first]
+            })
+            # detections without transmitter or station name do not end up in an interval
+            outdf = outdf[outdf['transmitter'].notnull() & outdf['stationname'].notnull()]
+            outdf.index = pd.Index(range(len(outdf)))
+            stage.rows_out = len(outdf)
+        return outdf
+
+    def multi_intervals(self, sorted_data, minutes_deltas):
+        """
+        Return the intervals of detections sorted by sort_detections for each of minutes_deltas, one after the other,
+        with the minutes_delta they belong to in a minutes column. The gaps are computed only once for all of them.
+        """
+        gaps = self.interval_gaps(sorted_data)
+        return pd.concat([
+            self.intervals(sorted_data, minutes_delta=minutes_delta, gaps=gaps).assign(minutes=minutes_delta)
+            for minutes_delta in minutes_deltas
+        ], ignore_index=True)
+
+    def format_timestamps(self, inseries, time_format='unix'):
+        if time_format == 'unix':
+            return (inseries.values.view('i8') // 10 ** 9).astype(str)
+        elif time_format == 'iso':
+            index = pd.DatetimeIndex(inseries)
+            # isoformat() only shows the fraction of a second when there is one
+            return np.where(index.microsecond != 0, np.asarray(index.strftime('%Y-%m-%dT%H:%M:%S.%f')),
+                            np.asarray(index.strftime('%Y-%m-%dT%H:%M:%S')))
+        raise Exception('Unknown time format {0}'.format(time_format))
+
+    def format_intervals(self, intervals, time_format='unix'):
+        with self.metrics.stage('format', rows_in=len(intervals)) as stage:
+            outdf = pd.DataFrame(data={
+                'start': self.format_timestamps(intervals['start'], time_format),
+                'stop': self.format_timestamps(intervals['stop'], time_format),
+                'transmitter': intervals['transmitter'],
+                'stationname': intervals['stationname']
+            })
+            # columns added by later stages, e.g. flags, follow the interval columns
+            for column in intervals.columns.difference(outdf.columns):
+                outdf[column] = intervals[column].values
+            stage.rows_out = len(outdf)
+        return outdf
+
+    def filter_isolated(self, detections, window):
+        """
+        Drop the detections that have no other detection of the same transmitter at the same station within window
+        seconds. Such isolated detections are likely false. The number of dropped rows is added to isolated_removed.
+        Detections without transmitter or station name are kept, they do not end up in intervals anyway.
+        """
+        with self.metrics.stage('filter_isolated', rows_in=len(detections)) as stage:
+            timestamps = detections['timestamp'].values
+            if timestamps.dtype.kind == 'M':
+                timestamps = timestamps.view('i8') // 10 ** 9
+            transmitters = pd.factorize(detections['transmitter'])[0]
+            stations = pd.factorize(detections['stationname'])[0]
+            order = np.lexsort((timestamps, stations, transmitters))
+            timestamps, transmitters, stations = timestamps[order], transmitters[order], stations[order]
+            # a detection is confirmed by its neighbour in this order if that has the same transmitter and station
+            near = (
+                (transmitters[1:] == transmitters[:-1]) &
+                (stations[1:] == stations[:-1]) &
+                (timestamps[1:] - timestamps[:-1] <= window)
+            )
+            confirmed = (transmitters < 0) | (stations < 0)
+            confirmed[1:] |= near
+            confirmed[:-1] |= near
+            keep = np.empty(len(order), dtype=bool)
+            keep[order] = confirmed
+            filtered = detections[keep]
+            stage.rows_out = len(filtered)
+        self.isolated_removed += len(detections) - len(filtered)
+        return filtered
+
     def aggregate(self, indata, minutes_delta=30, time_format='unix'):
-        print '{0} AGGREGATOR: starting to aggregate detections'.format(datetime.now().isoformat())
-        print '{0} AGGREGATOR:    sorting detections...'.format(datetime.now().isoformat())
-        sorted_data = indata.sort(['transmitter', 'timestamp'])
-        print '{0} AGGREGATOR:    calculating interval id...'.format(datetime.now().isoformat())
-        sorted_data['interval_id'] = (sorted_data['timestamp'].diff() >= timedelta(minutes=minutes_delta)).cumsum()
-        print '{0} AGGREGATOR:    calculating station interval id...'.format(datetime.now().isoformat())
-        sorted_data['station_interval_id'] = (sorted_data['stationname'] != sorted_data['stationname'].shift()).cumsum()
-        print '{0} AGGREGATOR:    performing group by...'.format(datetime.now().isoformat())
-        grouped = sorted_data.groupby(['interval_id', 'station_interval_id', 'transmitter', 'stationname'])
-        starts = []
-        stops = []
-        transmitters = []
-        stationnames = []
-        print '{0} AGGREGATOR:    formatting intervals...'.format(datetime.now().isoformat())
-        for name, group in grouped:
-            if time_format == 'unix':
-                starts.append(str(self.unix_time(group['timestamp'].min())))
-                stops.append(str(self.unix_time(group['timestamp'].max())))
-            elif time_format == 'iso':
-                starts.append(str(group['timestamp'].min().isoformat()))
-                stops.append(str(group['timestamp'].max().isoformat()))
-            transmitters.append(name[2])
-            stationnames.append(name[3])
-        outdf = pd.DataFrame(data={
-            'start': starts,
-            'stop': stops,
-            'transmitter': transmitters,
-            'stationname': stationnames
-        })
-        print '{0} AGGREGATOR: aggregation done'.format(datetime.now().isoformat())
+        self.log('starting to aggregate detections')
+        if self.isolation_window:
+            self.log('   removing isolated detections...')
+            indata = self.filter_isolated(indata, self.isolation_window)
+        self.log('   sorting detections...')
+        sorted_data = self.sort_detections(indata)
+        self.log('   calculating intervals...')
+        if isinstance(minutes_delta, (list, tuple)):
+            intervals = self.multi_intervals(sorted_data, minutes_delta)
+        else:
+            intervals = self.intervals(sorted_data, minutes_delta=minutes_delta)
+        if time_format is None:
+            # the caller formats the intervals, e.g. while writing them
+            self.log('aggregation done')
+            return intervals
+        self.log('   formatting intervals...')
+        outdf = self.format_intervals(intervals, time_format)
+        self.log('aggregation done')
         return outdf
+
+
+register_format(DetectionFormat(
+    'vliz',
+    columns=[
+        'Date(UTC)',
+        'Time(UTC)',
+        'Receiver',
+        'Transmitter',
+        'TransmitterName',
+        'TransmitterSerial',
+        'SensorValue',
+        'SensorUnit',
+        'StationName',
+        'Latitude',
+        'Longitude'
+    ],
+    usecols=['Date(UTC)', 'Time(UTC)', 'Receiver', 'Transmitter', 'StationName'],
+    dtype={'Date(UTC)': str, 'Time(UTC)': str, 'Receiver': 'category', 'Transmitter': 'category', 'StationName': str},
+    parser=Aggregator.parse_vliz_detections
+))
+register_format(DetectionFormat(
+    'vliz_2',
+    columns=[
+        'Date and Time (UTC)',
+        'Receiver',
+        'Transmitter',
+        'Transmitter Name',
+        'Transmitter Serial',
+        'Sensor Value',
+        'Sensor Unit',
+        'Station Name',
+        'Latitude',
+        'Longitude'
+    ],
+    usecols=['Date and Time (UTC)', 'Receiver', 'Transmitter', 'Station Name'],
+    dtype={'Date and Time (UTC)': str, 'Receiver': 'category', 'Transmitter': 'category', 'Station Name': str},
+    parser=Aggregator.parse_vliz_2_detections
+))
+register_format(DetectionFormat(
+    'inbo',
+    columns=[
+        'Date/Time',
+        'Code Space',
+        'ID',
+        'Sensor 1',
+        'Units 1',
+        'Sensor 2',
+        'Units 2',
+        'Transmitter Name',
+        'Transmitter S/N',
+        'Receiver Name',
+        'Receiver S/N',
+        'Station Name',
+        'Station Latitude',
+        'Station Longitude'
+    ],
+    usecols=['Date/Time', 'Code Space', 'ID', 'Receiver Name', 'Receiver S/N', 'Station Name'],
+    dtype={'Date/Time': str, 'Code Space': str, 'ID': str, 'Receiver Name': 'category', 'Receiver S/N': str,
+           'Station Name': str},
+    parser=Aggregator.parse_inbo_detections
+))
+register_format(DetectionFormat(
+    'vue_export',
+    columns=[
+        'date_time_utc',
+        'receiver_id',
+        'transmitter_id',
+        'old_station_name',
+        'station_name',
+        'latitude',
+        'longitude'
+    ],
+    usecols=['date_time_utc', 'receiver_id', 'transmitter_id', 'station_name'],
+    dtype={'date_time_utc': str, 'receiver_id': 'category', 'transmitter_id': 'category', 'station_name': str},
+    parser=Aggregator.parse_vue_export_detections
+))
@@ -1,51 +1,648 @@
-from fish_tracking import Aggregator
+from fish_tracking import REJECT_COLUMNS, Aggregator, StationMapper
+from cache import DetectionCache
+from incremental import IncrementalAggregator
+from external import external_aggregate
+from sharded import sharded_aggregate
+from timer import Metrics, peak_rss_mb
+from output import FORMATS, COMPRESSIONS, PARTITIONS, SplitWriter, open_writer
+from compressed import is_detection_file
+from store import DetectionStore
+from dedup import Deduplicator
+import network as movements
+import residency
+from swimspeed import DEFAULT_MAX_SPEED, DistanceMatrix, SpeedFilter, read_species
+from watch import DirectoryWatcher
+from multiprocessing import Pool
+import cProfile
 import click
-import sys
+import itertools
+import json
 import os
+import shutil
+import tempfile
+import time
 import pandas as pd
 
+def new_aggregator(**options):
+    """Return an Aggregator that records its stages in the metrics of the fish_tracking command"""
+    return Aggregator(metrics=click.get_current_context().find_object(Metrics), **options)
+
+def parse_file(task):
+    """
+    Parse one detections file. Errors are returned rather than raised, so one bad file does not stop the others. The
+    metrics of the file are returned as well, because those recorded in a worker process are lost otherwise.
+    """
+    agg, path, st_mapping, cache = task
+    metrics, agg.metrics = agg.metrics, Metrics()
+    rejected, agg.rejected = agg.rejected, []
+    if agg.quarantine:
+        # the cache only has the valid rows, so the rejected ones would be missing from the quarantine file
+        cache = None
+    try:
+        detections = cache.get(path, st_mapping) if cache else None
+        if detections is None:
+            detections = agg.parse_detections(path, station_mapping=st_mapping)
+            if cache:
+                cache.put(path, st_mapping, detections)
+        if agg.compact:
+            detections = agg.compact_detections(detections)
+        result = path, detections, None
+    except Exception as e:
+        result = path, None, '{0}: {1}'.format(type(e).__name__, e)
+    file_metrics, agg.metrics = agg.metrics, metrics
+    file_rejected, agg.rejected = agg.rejected, rejected
+    return result + (file_metrics, file_rejected)
+
+def detection_files(directory):
+    """Return the paths of the csv files in directory, compressed or not, in file name order"""
+    return [os.path.join(directory, fname) for fname in sorted(os.listdir(directory)) if is_detection_file(fname)]
+
+def parse_files(agg, paths, st_mapping, jobs=1, debug=False, cache=None, pool=None, on_error=None):
+    """Parse the files in paths with iter_files and return a list of (path, detections) in the order of paths"""
+    return list(iter_files(agg, paths, st_mapping, jobs=jobs, debug=debug, cache=cache, pool=pool, on_error=on_error))
+
+def iter_files(agg, paths, st_mapping, jobs=1, debug=False, cache=None, pool=None, on_error=None):
+    """
+    Parse the files in paths, in a pool of jobs processes if jobs > 1, and yield (path, detections) in the order of
+    paths as soon as a file is parsed. Files with an entry in cache are not parsed again. A pool that is passed is
+    used instead and left open. Files that can not be parsed are passed to on_error if it is given, otherwise they
+    raise a ClickException after the other files are parsed.
+    """
+    tasks = [(agg, path, st_mapping, cache) for path in paths]
+    own_pool = None
+    if pool is None and jobs > 1:
+        pool = own_pool = Pool(jobs)
+    if pool:
+        results = pool.imap(parse_file, tasks, chunksize=1)
+    else:
+        results = itertools.imap(parse_file, tasks)
+    errors = []
+    try:
+        for path, tmpdetections, error, file_metrics, file_rejected in results:
+            agg.metrics.merge(file_metrics)
+            agg.rejected.extend(file_rejected)
+            if debug:
+                click.echo(os.path.basename(path), err=True)
+            if error:
+                click.echo('Could not parse {0}: {1}'.format(path, error), err=True)
+                if agg.quarantine:
+                    reject_file(agg, path, error)
+                    continue
+                errors.append(path)
+                if on_error:
+                    on_error(path)
+            else:
+                yield path, tmpdetections
+    finally:
+        if own_pool:
+            own_pool.close()
+            own_pool.join()
+    if cache:
+        cache.evict()
+    if errors and not on_error:
+        raise click.ClickException('{0} of {1} files could not be parsed'.format(len(errors), len(tasks)))
+
+def reject_file(agg, path, error):
+    """Quarantine a file that could not be parsed at all, as one rejected row without line"""
+    agg.rejected.append(pd.DataFrame(data={'file': [path], 'reason': [error]}, columns=REJECT_COLUMNS))
+
+def deduplicate(agg, deduplicator, path, detections):
+    if deduplicator is None:
+        return detections
+    with agg.metrics.stage('deduplicate', rows_in=len(detections)) as stage:
+        detections = deduplicator.deduplicate(path, detections)
+        stage.rows_out = len(detections)
+    return detections
+
+def read_detections(agg, directory, st_mapping, jobs=1, debug=False, cache=None, deduplicator=None):
+    """
+    Parse all csv files in directory with parse_files and concatenate them in file name order, without the detections
+    deduplicator has seen in an earlier file if it is given
+    """
+    parsed = parse_files(agg, detection_files(directory), st_mapping, jobs=jobs, debug=debug, cache=cache)
+    return agg.concat_detections([deduplicate(agg, deduplicator, path, detections) for path, detections in parsed])
+
+def stream_detections(agg, directory, st_mapping, chunksize, writer, debug=False, deduplicator=None):
+    """
+    Parse all csv files in directory chunk by chunk and write the detections with writer as they are parsed. When
+    quarantining, the chunks of a file are spilled to a temporary directory and only written once the whole file is
+    parsed, so a file that is quarantined leaves no detections in the output.
+    """
+    paths = detection_files(directory)
+    errors = []
+    for path in paths:
+        if debug:
+            click.echo(os.path.basename(path), err=True)
+        spill = tempfile.mkdtemp(prefix='ft-chunks-') if agg.quarantine else None
+        try:
+            chunks = []
+            for chunk in agg.iter_detections(path, station_mapping=st_mapping, chunksize=chunksize):
+                if spill is None:
+                    write_output(agg, writer, deduplicate(agg, deduplicator, path, chunk))
+                else:
+                    chunks.append(os.path.join(spill, 'chunk-{0:06d}.pkl'.format(len(chunks))))
+                    chunk.to_pickle(chunks[-1])
+            for chunk_path in chunks:
+                write_output(agg, writer, deduplicate(agg, deduplicator, path, pd.read_pickle(chunk_path)))
+        except Exception as e:
+            file_error(agg, path, e, errors)
+        finally:
+            if spill:
+                shutil.rmtree(spill)
+    if errors:
+        raise click.ClickException('{0} of {1} files could not be parsed'.format(len(errors), len(paths)))
+
+def file_error(agg, path, e, errors):
+    """Report a file that could not be parsed, and quarantine it or add it to errors"""
+    error = '{0}: {1}'.format(type(e).__name__, e)
+    click.echo('Could not parse {0}: {1}'.format(path, error), err=True)
+    if agg.quarantine:
+        reject_file(agg, path, error)
+    else:
+        errors.append(path)
+
+def open_cache(cache_dir, cache_size):
+    if not cache_dir:
+        return None
+    return DetectionCache(cache_dir, max_size=cache_size * 1024 * 1024 if cache_size is not None else None)
+
+def open_output(output, output_format, compression, partition_by, time_column, formatter=None, atomic=False):
+    try:
+        return open_writer(output, output_format=output_format, compression=compression, partition_by=partition_by,
+                           time_column=time_column, formatter=formatter, atomic=atomic)
+    except Exception as e:
+        raise click.UsageError(str(e))
+
+def open_interval_output(agg, output, thresholds, output_format, compression, partition_by):
+    """
+    Open the output of aggregate: one writer, or one for every threshold in thresholds if output has {minutes} in it,
+    which is replaced by the threshold
+    """
+    formatter = lambda intervals: agg.format_intervals(intervals, time_format='iso')
+    if '{minutes}' not in output:
+        return open_output(output, output_format, compression, partition_by, 'start', formatter=formatter)
+    return SplitWriter('minutes', dict(
+        (minutes, open_output(output.format(minutes=minutes), output_format, compression, partition_by, 'start',
+                              formatter=formatter))
+        for minutes in thresholds))
+
+def write_output(agg, writer, frame):
+    with agg.metrics.stage('write', rows_in=len(frame)):
+        writer.write(frame)
+
+def open_deduplicator(dedup, tolerance, tmpdir=None):
+    return Deduplicator(tolerance=tolerance, tmpdir=tmpdir) if dedup else None
+
+def close_deduplicator(deduplicator):
+    if deduplicator is not None:
+        deduplicator.close()
+
+def report_duplicates(deduplicator):
+    if deduplicator is not None:
+        click.echo('{0} duplicate detections removed'.format(deduplicator.removed()), err=True)
+        if deduplicator.counts:
+            click.echo(deduplicator.report().to_string(index=False), err=True)
+
+def report_rejected(agg, quarantine):
+    """Write the rows rejected by quarantine to the quarantine file and how many were rejected per file to stderr"""
+    if not quarantine:
+        return
+    rejected = agg.rejected_rows()
+    lines = rejected['line']
+    writer = open_output(quarantine, None, None, None, 'timestamp')
+    try:
+        # files that could not be parsed have no line
+        writer.write(rejected.assign(line=lines.fillna(0).astype('i8').astype(str).where(lines.notnull(), '')))
+    finally:
+        writer.close()
+    click.echo('{0} invalid rows quarantined to {1}'.format(len(rejected), quarantine), err=True)
+    if len(rejected) > 0:
+        summary = rejected.groupby([rejected['file'].map(os.path.basename), 'reason']).size()
+        with pd.option_context('display.max_colwidth', 1000):
+            click.echo(summary.rename('rows').reset_index().to_string(index=False), err=True)
+
+quarantine_option = click.option('--quarantine', type=click.Path(dir_okay=False), help='write rows with an invalid timestamp or station name or without transmitter to this csv file, with their file and line, instead of failing their file')
+
+def report_isolated(agg):
+    if agg.isolation_window:
+        click.echo('{0} isolated detections removed'.format(agg.isolated_removed), err=True)
+
+isolation_window_option = click.option('--isolation-window', type=int, help='drop detections without another detection of the same transmitter at the same station within this many seconds, e.g. 30 times the nominal ping delay')
+
+def dedup_options(command):
+    """Options to remove detections that are in more than one file"""
+    command = click.option('--dedup-tolerance', default=0, help='compare timestamps floored to this many seconds, e.g. 60 for minute-resolution INBO exports (default: 0, exact)')(command)
+    command = click.option('--dedup', is_flag=True, help='remove detections (same transmitter, receiver and timestamp) that are in an earlier file too, and report them on stderr')(command)
+    return command
+
+def open_speed_filter(distances, max_speed, species, species_speed, drop_implausible, cache_dir):
+    if not distances:
+        return None
+    speeds = {}
+    for value in species_speed:
+        name, separator, speed = value.rpartition('=')
+        try:
+            speeds[name] = float(speed)
+        except ValueError:
+            separator = ''
+        if not separator:
+            raise click.BadParameter('{0} is not SPECIES=M/S'.format(value), param_hint='--species-speed')
+    matrix = DistanceMatrix(distances, cache_dir=os.path.join(cache_dir, 'distances') if cache_dir else None)
+    return SpeedFilter(matrix, max_speed=max_speed, species=read_species(species) if species else None,
+                       species_speeds=speeds, drop=drop_implausible)
+
+def check_speeds(agg, speed_filter, frame, is_sorted=True):
+    if speed_filter is None:
+        return frame
+    with agg.metrics.stage('swim_speed', rows_in=len(frame)) as stage:
+        frame = speed_filter.filter_sorted(frame) if is_sorted else speed_filter.filter(frame, agg)
+        stage.rows_out = len(frame)
+    return frame
+
+def report_speeds(speed_filter):
+    if speed_filter is not None:
+        click.echo('{0} moves with an implausible swim speed {1}'.format(
+            speed_filter.flagged, 'dropped' if speed_filter.drop else 'flagged'), err=True)
+
+def speed_options(command):
+    """Options to flag or drop moves between stations that are too fast for the fish"""
+    command = click.option('--drop-implausible', is_flag=True, help='drop moves that are too fast instead of flagging them in an implausible_speed column')(command)
+    command = click.option('--species-speed', multiple=True, help='maximum swim speed of a species as SPECIES=M/S, can be repeated')(command)
+    command = click.option('--species', type=click.Path(exists=True, dir_okay=False), help='csv file with the species of every transmitter (columns transmitter and species)')(command)
+    command = click.option('--max-speed', default=DEFAULT_MAX_SPEED, help='maximum swim speed in m/s of transmitters without a species speed (default: {0})'.format(DEFAULT_MAX_SPEED))(command)
+    command = click.option('--distances', type=click.Path(exists=True, dir_okay=False), help='distance matrix between stations (receiver_distance_analysis/results/distancematrix_*.csv) to check swim speeds with')(command)
+    return command
+
+def output_options(command):
+    """Options for the file, format, compression and partitioning of the output of command"""
+    command = click.option('--partition-by', type=click.Choice(PARTITIONS), help='write a directory with a csv or parquet file per transmitter or per month to OUTPUT')(command)
+    command = click.option('--compression', type=click.Choice(COMPRESSIONS), help='compression of the output (default: from the extension of OUTPUT, .gz or .zst)')(command)
+    command = click.option('--format', 'output_format', type=click.Choice(FORMATS), help='output format (default: from the extension of OUTPUT, parquet for .parquet, csv otherwise)')(command)
+    command = click.option('--output', default='-', type=click.Path(), help='file or, with --partition-by, directory to write to (default: stdout)')(command)
+    return command
+
+cache_dir_option = click.option('--cache-dir', envvar='FT_CACHE_DIR', type=click.Path(file_okay=False), help='directory to cache parsed files in. Unchanged files are not parsed again.')
+cache_size_option = click.option('--cache-size', type=int, help='maximum size of the cache in MB. The least recently used files are removed first.')
+
 @click.group()
-def fish_tracking():
-    pass
+@click.option('--metrics', is_flag=True, help='write wall time, rows and peak memory of every stage and of the process to stderr')
+@click.option('--metrics-file', type=click.Path(dir_okay=False), help='write wall time, rows and peak memory of every stage and of the process as JSON to this file')
+@click.option('--profile', type=click.Path(dir_okay=False), help='write a cProfile profile of the run to this file, e.g. for snakeviz, gprof2dot or flameprof')
+@click.pass_context
+def fish_tracking(ctx, metrics, metrics_file, profile):
+    ctx.obj = Metrics()
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        def dump_profile():
+            profiler.disable()
+            profiler.dump_stats(profile)
+        ctx.call_on_close(dump_profile)
+    def report_metrics():
+        if metrics:
+            click.echo(ctx.obj.to_string(), err=True)
+            click.echo('peak RSS of the process: {0:.1f} MB'.format(peak_rss_mb()), err=True)
+        if metrics_file:
+            with open(metrics_file, 'w') as f:
+                json.dump({'stages': ctx.obj.report(), 'peak_rss_mb': peak_rss_mb()}, f, indent=2)
+    ctx.call_on_close(report_metrics)
 
 @click.command()
 @click.argument('DIRECTORY', type=click.Path(exists=True))
-@click.option('--minutes', default=60, help='maximum number of minutes in interval (default: 60)')
+@click.option('--minutes', type=int, multiple=True, default=[60], help='maximum number of minutes in interval (default: 60). Can be repeated to aggregate for several thresholds at once: the intervals get a minutes column, or go to a file per threshold if OUTPUT contains {minutes}.')
 @click.option('--st_mapping', default='./data/station_names.md', help='points to the station names mapping file. If given, old stations names will be replaced by new ones.')
+@click.option('--jobs', default=1, help='number of files to parse in parallel (default: 1)')
+@cache_dir_option
+@cache_size_option
+@click.option('--state', type=click.Path(file_okay=False), help='directory with the aggregation state of previous runs. Only new or changed files are parsed and only new or changed intervals are written.')
+@click.option('--compact/--no-compact', default=True, help='keep detections in memory as epoch seconds and categoricals (default: compact)')
+@click.option('--memory-report', is_flag=True, help='write the memory used by the detections to stderr')
+@click.option('--external', is_flag=True, help='sort the detections on disk, so memory use does not grow with the number of files')
+@click.option('--chunksize', default=1000000, help='rows per sorted run on disk with --external (default: 1000000)')
+@click.option('--tmpdir', type=click.Path(exists=True, file_okay=False), help='directory for the sorted runs of --external, the shards of --shards or the keys spilled by --dedup (default: system temporary directory)')
+@click.option('--shards', type=int, help='split the detections by transmitter into this many shards, which are sorted and aggregated in --jobs processes, e.g. 4 times --jobs')
+@quarantine_option
+@dedup_options
+@isolation_window_option
+@speed_options
+@output_options
 @click.option('--debug/--no-debug', default=False)
-def aggregate(directory, minutes, st_mapping, debug):
+def aggregate(directory, minutes, st_mapping, jobs, cache_dir, cache_size, state, compact, memory_report, external, chunksize, tmpdir, shards, quarantine, dedup, dedup_tolerance, isolation_window, distances, max_speed, species, species_speed, drop_implausible, output, output_format, compression, partition_by, debug):
     """Create aggregated detections file based on data in DIRECTORY"""
-    agg = Aggregator()
-    detection_dataframes = []
-    for fname in os.listdir(directory):
-        if fname.split('.')[-1] == 'csv':
-            if debug:
-                print fname
-            tmpdetections = agg.parse_detections(os.path.join(directory, fname), station_mapping=st_mapping)
-            detection_dataframes.append(tmpdetections)
-    detections = pd.concat(detection_dataframes)
-    intervals = agg.aggregate(detections, minutes_delta=minutes, time_format='iso')
-    print intervals.to_csv(index=False)
+    agg = new_aggregator(logging=debug, compact=compact, isolation_window=isolation_window, quarantine=bool(quarantine))
+    st_mapping = StationMapper(st_mapping)
+    cache = open_cache(cache_dir, cache_size)
+    if external and state:
+        raise click.UsageError('--external can not be combined with --state')
+    if dedup and state:
+        raise click.UsageError('--dedup can not be combined with --state')
+    if distances and state:
+        raise click.UsageError('--distances can not be combined with --state')
+    if isolation_window and (state or external):
+        raise click.UsageError('--isolation-window can not be combined with --state or --external')
+    if shards and (state or external):
+        raise click.UsageError('--shards can not be combined with --state or --external')
+    if shards is not None and shards < 1:
+        raise click.BadParameter('needs at least 1 shard', param_hint='--shards')
+    thresholds = sorted(set(minutes))
+    # several thresholds share the sorting and the gaps between detections, and come out with a minutes column
+    minutes = thresholds[0]
+    if len(thresholds) > 1 or '{minutes}' in output:
+        if state or external:
+            raise click.UsageError('--state and --external aggregate for one --minutes and without {minutes} in --output')
+        if distances:
+            raise click.UsageError('--distances can not be combined with several --minutes')
+        minutes = thresholds
+    deduplicator = open_deduplicator(dedup, dedup_tolerance, tmpdir)
+    speed_filter = open_speed_filter(distances, max_speed, species, species_speed, drop_implausible, cache_dir)
+    writer = open_interval_output(agg, output, thresholds, output_format, compression, partition_by)
+    try:
+        if external:
+            paths = detection_files(directory)
+            errors = []
+            for intervals in external_aggregate(agg, paths, station_mapping=st_mapping, minutes_delta=minutes,
+                                                chunksize=chunksize, tmpdir=tmpdir, deduplicator=deduplicator,
+                                                on_error=lambda path, e: file_error(agg, path, e, errors)):
+                # all files are parsed before the first intervals are merged
+                if errors:
+                    break
+                write_output(agg, writer, check_speeds(agg, speed_filter, intervals))
+            if errors:
+                raise click.ClickException('{0} of {1} files could not be parsed'.format(len(errors), len(paths)))
+            report_rejected(agg, quarantine)
+            report_duplicates(deduplicator)
+            report_speeds(speed_filter)
+            return
+        if state:
+            try:
+                incremental = IncrementalAggregator(state, agg, minutes_delta=minutes)
+            except Exception as e:
+                raise click.ClickException(str(e))
+            paths = incremental.changed_files(detection_files(directory))
+            parsed = parse_files(agg, paths, st_mapping, jobs=jobs, debug=debug, cache=cache)
+            report_rejected(agg, quarantine)
+            write_output(agg, writer, incremental.update(dict(parsed)))
+            return
+        detections = read_detections(agg, directory, st_mapping, jobs=jobs, debug=debug, cache=cache,
+                                     deduplicator=deduplicator)
+        report_rejected(agg, quarantine)
+        report_duplicates(deduplicator)
+        if memory_report:
+            click.echo(agg.memory_report(detections).to_string(), err=True)
+        if shards:
+            intervals = sharded_aggregate(agg, detections, minutes_delta=minutes, shards=shards, jobs=jobs, tmpdir=tmpdir)
+        else:
+            intervals = agg.aggregate(detections, minutes_delta=minutes, time_format=None)
+        intervals = check_speeds(agg, speed_filter, intervals)
+        report_isolated(agg)
+        report_speeds(speed_filter)
+        write_output(agg, writer, intervals)
+    finally:
+        writer.close()
+        close_deduplicator(deduplicator)
+
+@click.command()
+@click.argument('DIRECTORY', type=click.Path(exists=True, file_okay=False))
+@click.option('--state', type=click.Path(file_okay=False), required=True, help='directory with the aggregation state, kept between runs')
+@click.option('--minutes', default=60, help='maximum number of minutes in interval (default: 60)')
+@click.option('--st_mapping', default='./data/station_names.md', help='points to the station names mapping file. If given, old stations names will be replaced by new ones.')
+@click.option('--jobs', default=1, help='number of files to parse in parallel (default: 1)')
+@click.option('--interval', default=10.0, help='seconds between two looks at DIRECTORY (default: 10)')
+@click.option('--settle', default=30.0, help='seconds a file has to be unchanged before it is parsed, so files that are still being copied are skipped (default: 30)')
+@click.option('--batch-size', default=200, help='maximum number of files parsed per update (default: 200)')
+@click.option('--once', is_flag=True, help='ingest the files that are ready and stop, instead of watching DIRECTORY')
+@output_options
+@click.option('--debug/--no-debug', default=False)
+def watch(directory, state, minutes, st_mapping, jobs, interval, settle, batch_size, once, output, output_format, compression, partition_by, debug):
+    """Keep the aggregated detections of DIRECTORY up to date while new or changed files land in it"""
+    agg = new_aggregator(logging=debug)
+    st_mapping = StationMapper(st_mapping)
+    if output == '-':
+        raise click.UsageError('watch needs an --output file or directory, which is replaced after every update')
+    try:
+        incremental = IncrementalAggregator(state, agg, minutes_delta=minutes)
+    except Exception as e:
+        raise click.ClickException(str(e))
+    watcher = DirectoryWatcher(incremental, settle=settle, batch_size=batch_size)
+    pool = Pool(jobs) if jobs > 1 else None
+    try:
+        while True:
+            paths = watcher.ready(detection_files(directory))
+            if paths:
+                parsed = parse_files(agg, paths, st_mapping, debug=debug, pool=pool, on_error=watcher.fail)
+                if parsed:
+                    changed = incremental.update(dict(parsed))
+                    writer = open_output(output, output_format, compression, partition_by, 'start',
+                                         formatter=lambda intervals: agg.format_intervals(intervals, time_format='iso'),
+                                         atomic=True)
+                    write_output(agg, writer, incremental.intervals())
+                    writer.close()
+                    click.echo('{0} files ingested, {1} intervals new or changed'.format(len(parsed), len(changed)),
+                               err=True)
+            elif once:
+                break
+            else:
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
 
 @click.command()
 @click.argument('DIRECTORY', type=click.Path(exists=True))
 @click.option('--st_mapping', default='./data/station_names.csv', help='points to the station names mapping file. If given, old stations names will be replaced by new ones.')
+@click.option('--jobs', default=1, help='number of files to parse in parallel (default: 1)')
+@click.option('--chunksize', type=int, help='stream the files in chunks of this many rows instead of reading them completely')
+@cache_dir_option
+@cache_size_option
+@quarantine_option
+@dedup_options
+@isolation_window_option
+@speed_options
+@output_options
 @click.option('--debug/--no-debug', default=False)
-def parse(directory, st_mapping, debug):
+def parse(directory, st_mapping, jobs, chunksize, cache_dir, cache_size, quarantine, dedup, dedup_tolerance, isolation_window, distances, max_speed, species, species_speed, drop_implausible, output, output_format, compression, partition_by, debug):
     """Create consolidated detections file based on data in DIRECTORY but do not aggregate time frames"""
-    agg = Aggregator(logging=debug)
-    detection_dataframes = []
-    for fname in os.listdir(directory):
-        if fname.split('.')[-1] == 'csv':
-            if debug:
-                print fname
-            tmpdetections = agg.parse_detections(os.path.join(directory, fname), station_mapping=st_mapping)
-            detection_dataframes.append(tmpdetections)
-    detections = pd.concat(detection_dataframes)
-    print detections.to_csv(index=False)
+    agg = new_aggregator(logging=debug, isolation_window=isolation_window, quarantine=bool(quarantine))
+    st_mapping = StationMapper(st_mapping)
+    if chunksize and jobs > 1:
+        raise click.UsageError('--chunksize can not be combined with --jobs')
+    if chunksize and (distances or isolation_window):
+        raise click.UsageError('--chunksize can not be combined with --distances or --isolation-window')
+    deduplicator = open_deduplicator(dedup, dedup_tolerance)
+    speed_filter = open_speed_filter(distances, max_speed, species, species_speed, drop_implausible, cache_dir)
+    writer = open_output(output, output_format, compression, partition_by, 'timestamp')
+    try:
+        if chunksize:
+            stream_detections(agg, directory, st_mapping, chunksize, writer, debug=debug, deduplicator=deduplicator)
+            report_rejected(agg, quarantine)
+            report_duplicates(deduplicator)
+            return
+        cache = open_cache(cache_dir, cache_size)
+        detections = read_detections(agg, directory, st_mapping, jobs=jobs, debug=debug, cache=cache,
+                                     deduplicator=deduplicator)
+        report_rejected(agg, quarantine)
+        report_duplicates(deduplicator)
+        if isolation_window:
+            detections = agg.filter_isolated(detections, isolation_window)
+            report_isolated(agg)
+        detections = check_speeds(agg, speed_filter, detections, is_sorted=False)
+        report_speeds(speed_filter)
+        write_output(agg, writer, detections)
+    finally:
+        writer.close()
+        close_deduplicator(deduplicator)
+
+@click.command()
+@click.argument('DIRECTORY', type=click.Path(exists=True))
+@click.option('--database', required=True, type=click.Path(dir_okay=False), help='SQLite database to load the detections and intervals into')
+@click.option('--minutes', default=60, help='maximum number of minutes in interval (default: 60)')
+@click.option('--st_mapping', default='./data/station_names.csv', help='points to the station names mapping file. If given, old stations names will be replaced by new ones.')
+@click.option('--jobs', default=1, help='number of files to parse in parallel (default: 1)')
+@cache_dir_option
+@cache_size_option
+@click.option('--debug/--no-debug', default=False)
+def load(directory, database, minutes, st_mapping, jobs, cache_dir, cache_size, debug):
+    """
+    Load the detections in DIRECTORY and their intervals into a database. Only new or changed files are loaded. Every
+    file is loaded as soon as it is parsed; files that can not be parsed are left out and loaded on a next run.
+    """
+    agg = new_aggregator(logging=debug)
+    st_mapping = StationMapper(st_mapping)
+    cache = open_cache(cache_dir, cache_size)
+    store = DetectionStore(database, agg)
+    errors = []
+    try:
+        paths = store.changed_files(detection_files(directory))
+        # left by a load that stopped before it updated the intervals
+        transmitters = store.pending_transmitters()
+        for path, detections in iter_files(agg, paths, st_mapping, jobs=jobs, debug=debug, cache=cache,
+                                           on_error=errors.append):
+            with agg.metrics.stage('load', rows_in=len(detections)):
+                transmitters.update(store.load_file(path, detections))
+        store.update_intervals(transmitters, minutes_delta=minutes)
+    finally:
+        store.close()
+    click.echo('{0} files loaded'.format(len(paths) - len(errors)), err=True)
+    if errors:
+        raise click.ClickException('{0} of {1} files could not be parsed'.format(len(errors), len(paths)))
+
+@click.command()
+@click.option('--database', required=True, type=click.Path(exists=True, dir_okay=False), help='SQLite database created by load')
+@click.option('--transmitter', multiple=True, help='only this transmitter, can be repeated')
+@click.option('--station', multiple=True, help='only this station, can be repeated')
+@click.option('--start', help='only detections (or intervals) at or after this time, e.g. 2015-03-01')
+@click.option('--end', help='only detections (or intervals) at or before this time')
+@click.option('--intervals', is_flag=True, help='return aggregated intervals instead of detections')
+@output_options
+def query(database, transmitter, station, start, end, intervals, output, output_format, compression, partition_by):
+    """Select detections or intervals from a database created by load"""
+    agg = new_aggregator()
+    if intervals:
+        writer = open_output(output, output_format, compression, partition_by, 'start',
+                             formatter=lambda intervals: agg.format_intervals(intervals, time_format='iso'))
+    else:
+        writer = open_output(output, output_format, compression, partition_by, 'timestamp')
+    store = DetectionStore(database, agg)
+    try:
+        result = store.query('intervals' if intervals else 'detections', transmitters=transmitter, stations=station,
+                             start=start, end=end)
+        write_output(agg, writer, result)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    finally:
+        store.close()
+        writer.close()
+
+@click.command()
+@click.argument('INTERVALS', type=click.Path(exists=True, dir_okay=False))
+@click.option('--transitions', 'all_transitions', is_flag=True, help='write every transition instead of the edges with their counts')
+@click.option('--allow-loops', is_flag=True, help='count consecutive intervals at the same station as a transition too')
+@click.option('--all-transmitters', is_flag=True, help='count edges over all transmitters instead of per transmitter')
+@output_options
+def network(intervals, all_transitions, allow_loops, all_transmitters, output, output_format, compression, partition_by):
+    """Write the station network (edges or transitions) of the intervals in INTERVALS, a file written by aggregate"""
+    agg = new_aggregator()
+    with agg.metrics.stage('read') as stage:
+        intervals = pd.read_csv(intervals, compression='infer', dtype={'transmitter': str, 'stationname': str})
+        stage.rows_out = len(intervals)
+    with agg.metrics.stage('network', rows_in=len(intervals)) as stage:
+        result = movements.transitions(intervals, allow_loops=allow_loops)
+        time_columns = ['departure', 'arrival']
+        if not all_transitions:
+            result = movements.edges(result, by_transmitter=not all_transmitters)
+            time_columns = ['first_transition', 'last_transition']
+        stage.rows_out = len(result)
+    if all_transmitters and partition_by == 'transmitter':
+        raise click.UsageError('--partition-by transmitter can not be combined with --all-transmitters')
+    writer = open_output(output, output_format, compression, partition_by, time_columns[0],
+                         formatter=lambda frame: movements.format_times(frame, time_columns, agg))
+    try:
+        write_output(agg, writer, result)
+    finally:
+        writer.close()
+
+@click.command()
+@click.argument('INTERVALS', type=click.Path(exists=True, dir_okay=False))
+@click.option('--bin', 'bin_size', default='1D', show_default=True, help='bin size, such as 1D, 6H or 15min; bins start at midnight UTC')
+@click.option('--totals', is_flag=True, help='write the total residence per transmitter and station instead of per bin')
+@output_options
+def summarize(intervals, bin_size, totals, output, output_format, compression, partition_by):
+    """Write the presence and residence time per bin of the intervals in INTERVALS, a file written by aggregate"""
+    agg = new_aggregator()
+    with agg.metrics.stage('read') as stage:
+        intervals = pd.read_csv(intervals, compression='infer', dtype={'transmitter': str, 'stationname': str})
+        stage.rows_out = len(intervals)
+    with agg.metrics.stage('summarize', rows_in=len(intervals)) as stage:
+        try:
+            result = residency.summarize(intervals, bin_size)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--bin')
+        time_columns = ['bin']
+        if totals:
+            result = residency.total_residence(result)
+            time_columns = ['first_bin', 'last_bin']
+        stage.rows_out = len(result)
+    writer = open_output(output, output_format, compression, partition_by, time_columns[0],
+                         formatter=lambda frame: movements.format_times(frame, time_columns, agg))
+    try:
+        write_output(agg, writer, result)
+    finally:
+        writer.close()
+
+@click.group()
+def cache():
+    """Inspect or empty the cache of parsed files"""
+    pass
+
+@click.command()
+@click.option('--cache-dir', envvar='FT_CACHE_DIR', type=click.Path(file_okay=False), required=True)
+def stats(cache_dir):
+    """Show number and total size of the cached files"""
+    cache_stats = DetectionCache(cache_dir).stats()
+    print 'directory: {0}'.format(cache_stats['directory'])
+    print 'entries: {0}'.format(cache_stats['entries'])
+    print 'size: {0:.1f} MB'.format(cache_stats['size'] / 1024.0 / 1024.0)
+
+@click.command()
+@click.option('--cache-dir', envvar='FT_CACHE_DIR', type=click.Path(file_okay=False), required=True)
+def clear(cache_dir):
+    """Remove all cached files"""
+    DetectionCache(cache_dir).clear()
+
+cache.add_command(stats)
+cache.add_command(clear)
 
 fish_tracking.add_command(aggregate)
 fish_tracking.add_command(parse)
+fish_tracking.add_command(watch)
+fish_tracking.add_command(load)
+fish_tracking.add_command(query)
+fish_tracking.add_command(network)
+fish_tracking.add_command(summarize)
+fish_tracking.add_command(cache)
 
 if __name__ == '__main__':
-    fish_tracking()
\ No newline at end of file
+    fish_tracking()
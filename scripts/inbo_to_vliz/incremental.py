@@ -0,0 +1,160 @@
+from fish_tracking import Aggregator, timestamps_ns
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+INTERVAL_COLUMNS = ['start', 'stationname', 'stop', 'transmitter']
+
+def empty_intervals():
+    return pd.DataFrame(data={
+        'start': pd.Series([], dtype='datetime64[ns]'),
+        'stop': pd.Series([], dtype='datetime64[ns]'),
+        'transmitter': pd.Series([], dtype=object),
+        'stationname': pd.Series([], dtype=object)
+    })
+
+def sort_intervals(intervals):
+    intervals = intervals.sort_values(['transmitter', 'start', 'stop'])
+    intervals.index = pd.Index(range(len(intervals)))
+    return intervals
+
+def merge_open_intervals(open_intervals, new_intervals, minutes_delta):
+    """
+    Continue open intervals with the first new interval of the same transmitter if that one is at the same station and
+    starts less than minutes_delta after the open interval stopped. Both arguments have at most one open interval per
+    transmitter in open_intervals. Returns the updated open intervals and the new intervals that were not merged.
+    """
+    open_intervals = open_intervals.copy()
+    firsts = new_intervals.groupby(new_intervals['transmitter'].astype(object)).head(1)
+    joined = pd.merge(
+        open_intervals.reset_index(),
+        firsts.reset_index(),
+        on='transmitter',
+        suffixes=('_open', '_new')
+    )
+    mergeable = (
+        (joined['stationname_open'].astype(object) == joined['stationname_new'].astype(object)) &
+        (joined['start_new'] - joined['stop_open'] < np.timedelta64(minutes_delta * 60, 's'))
+    )
+    joined = joined[mergeable]
+    open_intervals.loc[joined['index_open'].values, 'stop'] = joined['stop_new'].values
+    return open_intervals, new_intervals.drop(joined['index_new'].values)
+
+class IncrementalAggregator():
+    """
+    Aggregation state that is kept in state_dir between runs, so new detections are folded into the intervals found
+    before instead of aggregating the full detection history again.
+
+    The state holds the intervals found so far, of which the last one of each transmitter is still open, and the
+    detections of every ingested file. Detections later than everything seen before for their transmitter only
+    extend or follow its open interval. Transmitters with detections arriving out of order, or from an input file
+    that changed, are aggregated again from the stored detections, so the result always equals a full aggregation.
+    """
+    def __init__(self, state_dir, aggregator=None, minutes_delta=30):
+        self.state_dir = state_dir
+        self.agg = aggregator or Aggregator()
+        self.minutes_delta = minutes_delta
+        self.batch_dir = os.path.join(state_dir, 'detections')
+        if not os.path.isdir(self.batch_dir):
+            os.makedirs(self.batch_dir)
+        self.state_file = os.path.join(state_dir, 'state.json')
+        self.intervals_file = os.path.join(state_dir, 'intervals.pkl')
+        if os.path.exists(self.state_file):
+            with open(self.state_file) as f:
+                self.state = json.load(f)
+            if self.state['minutes_delta'] != minutes_delta:
+                raise Exception('State in {0} was aggregated with {1} minutes, not {2}'.format(
+                    state_dir, self.state['minutes_delta'], minutes_delta))
+        else:
+            self.state = {'minutes_delta': minutes_delta, 'files': {}}
+
+    def fingerprint(self, path):
+        stat = os.stat(path)
+        return '{0}-{1!r}'.format(stat.st_size, stat.st_mtime)
+
+    def changed_files(self, paths):
+        """Return the paths that were not ingested yet or changed since they were"""
+        files = self.state['files']
+        return [path for path in paths if files.get(os.path.abspath(path), {}).get('fingerprint') != self.fingerprint(path)]
+
+    def intervals(self):
+        if not os.path.exists(self.intervals_file):
+            return empty_intervals()
+        return pd.read_pickle(self.intervals_file)
+
+    def batch_file(self, path):
+        return os.path.join(self.batch_dir, hashlib.sha1(path).hexdigest() + '.pkl')
+
+    def stored_detections(self, transmitters):
+        """Return the stored detections of the given transmitters, reading the stored files one at a time"""
+        selections = []
+        for entry in self.state['files'].values():
+            batch = pd.read_pickle(os.path.join(self.batch_dir, entry['batch']))
+            selections.append(batch[batch['transmitter'].isin(transmitters)])
+        if not selections:
+            return None
+        return pd.concat(selections)
+
+    def update(self, detections_by_file):
+        """
+        Fold the detections of the given files (a dict of path to parsed detections) into the state. Returns the
+        intervals that are new or changed.
+        """
+        old_intervals = self.intervals()
+        recompute = set()
+        new_detections = []
+        for path, detections in sorted(detections_by_file.items()):
+            path = os.path.abspath(path)
+            detections = detections[['timestamp', 'transmitter', 'stationname']]
+            detections = detections.assign(timestamp=timestamps_ns(detections))
+            if path in self.state['files']:
+                # the detections this file contributed before can be anywhere in the history of its transmitters
+                previous = pd.read_pickle(os.path.join(self.batch_dir, self.state['files'][path]['batch']))
+                recompute.update(previous['transmitter'].dropna().unique())
+                recompute.update(detections['transmitter'].dropna().unique())
+            else:
+                new_detections.append(detections)
+            detections.to_pickle(self.batch_file(path))
+            self.state['files'][path] = {
+                'fingerprint': self.fingerprint(path),
+                'batch': os.path.basename(self.batch_file(path))
+            }
+
+        open_intervals = old_intervals.groupby('transmitter').tail(1)
+        new_intervals = empty_intervals()
+        if new_detections:
+            new_detections = pd.concat(new_detections)
+            transmitters = new_detections['transmitter'].astype(object)
+            first_seen = new_detections['timestamp'].groupby(transmitters).min()
+            last_seen = open_intervals.set_index('transmitter')['stop']
+            # detections that do not come after everything seen before may split or join existing intervals
+            late = first_seen[first_seen.index.isin(last_seen.index)]
+            late = late[late.values <= last_seen[late.index].values]
+            recompute.update(late.index)
+            in_order = new_detections[~transmitters.isin(recompute)]
+            new_intervals = self.agg.intervals(self.agg.sort_detections(in_order), minutes_delta=self.minutes_delta)
+
+        kept = old_intervals[~old_intervals['transmitter'].isin(recompute)].copy()
+        kept_open = open_intervals[~open_intervals['transmitter'].isin(recompute)]
+        merged_open, new_intervals = merge_open_intervals(kept_open, new_intervals, self.minutes_delta)
+        if len(merged_open) > 0:
+            kept.loc[merged_open.index, 'stop'] = merged_open['stop'].values
+        parts = [kept, new_intervals]
+        if recompute:
+            stored = self.stored_detections(list(recompute))
+            parts.append(self.agg.intervals(self.agg.sort_detections(stored), minutes_delta=self.minutes_delta))
+        intervals = sort_intervals(pd.concat([part[INTERVAL_COLUMNS] for part in parts]).astype({
+            'transmitter': object, 'stationname': object}))
+
+        changed = pd.merge(intervals, old_intervals, on=INTERVAL_COLUMNS, how='left', indicator=True)
+        changed = changed[changed['_merge'] == 'left_only'][INTERVAL_COLUMNS]
+        changed.index = pd.Index(range(len(changed)))
+
+        intervals.to_pickle(self.intervals_file + '.tmp')
+        os.rename(self.intervals_file + '.tmp', self.intervals_file)
+        with open(self.state_file + '.tmp', 'w') as f:
+            json.dump(self.state, f)
+        os.rename(self.state_file + '.tmp', self.state_file)
+        return changed
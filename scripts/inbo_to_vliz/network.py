@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+
+# edge columns in the order the R scripts in network_analysis expect them: graph.data.frame takes the first two
+# columns as the vertices of an edge, and plyr's count() calls the number of edges freq
+EDGE_COLUMNS = ['receiver1', 'receiver2', 'freq', 'transmitter', 'first_transition', 'last_transition',
+                'mean_transit_seconds', 'median_transit_seconds']
+TRANSITION_COLUMNS = ['transmitter', 'receiver1', 'receiver2', 'departure', 'arrival', 'transit_seconds']
+
+def interval_times(inseries):
+    """Convert start or stop of intervals to datetime64, whether they are datetimes, unix or iso strings"""
+    if inseries.dtype.kind == 'M':
+        return inseries.values
+    if inseries.dtype.kind in 'iu' or inseries.astype(str).str.match(r'^-?\d+$').all():
+        return pd.to_datetime(inseries.astype('i8'), unit='s').values
+    return pd.to_datetime(inseries).values
+
+def transitions(intervals, allow_loops=False):
+    """
+    Return the moves between stations of every transmitter in intervals (as returned by Aggregator.aggregate): the
+    station left (receiver1) and the next one (receiver2), when it was left and arrived at, and the transit time.
+    Without allow_loops, consecutive intervals at the same station are joined into one visit first, so only changes of
+    station are transitions.
+    """
+    transmitters = intervals['transmitter'].astype(object).values
+    stations = intervals['stationname'].astype(object).values
+    starts = interval_times(intervals['start'])
+    stops = interval_times(intervals['stop'])
+    codes, uniques = pd.factorize(transmitters, sort=True)
+    order = np.lexsort((starts.view('i8'), codes))
+    transmitters, stations, starts, stops = transmitters[order], stations[order], starts[order], stops[order]
+    if not allow_loops and len(order) > 0:
+        # a visit starts at the first interval of a transmitter and at every change of station
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (transmitters[1:] != transmitters[:-1]) | (stations[1:] != stations[:-1])
+        visits = np.flatnonzero(first)
+        stops = np.maximum.reduceat(stops.view('i8'), visits).view('datetime64[ns]')
+        transmitters, stations, starts = transmitters[visits], stations[visits], starts[visits]
+    moves = np.flatnonzero(transmitters[1:] == transmitters[:-1])
+    departures = stops[moves]
+    arrivals = starts[moves + 1]
+    return pd.DataFrame(data={
+        'transmitter': transmitters[moves],
+        'receiver1': stations[moves],
+        'receiver2': stations[moves + 1],
+        'departure': departures,
+        'arrival': arrivals,
+        'transit_seconds': (arrivals - departures).astype('timedelta64[s]').astype('i8')
+    }, columns=TRANSITION_COLUMNS)
+
+def edges(transitions, by_transmitter=True):
+    """
+    Count the transitions between every pair of stations, per transmitter or over all transmitters, with the times of
+    the first and last arrival and the mean and median transit time
+    """
+    keys = ['transmitter', 'receiver1', 'receiver2'] if by_transmitter else ['receiver1', 'receiver2']
+    grouped = transitions.groupby(keys, sort=True)
+    result = pd.DataFrame({
+        'freq': grouped.size(),
+        'first_transition': grouped['arrival'].min(),
+        'last_transition': grouped['arrival'].max(),
+        'mean_transit_seconds': grouped['transit_seconds'].mean(),
+        'median_transit_seconds': grouped['transit_seconds'].median()
+    }).reset_index()
+    return result[[column for column in EDGE_COLUMNS if column in result]]
+
+def format_times(frame, columns, agg, time_format='iso'):
+    """Return frame with the datetime columns formatted like the intervals of Aggregator.format_intervals"""
+    frame = frame.copy()
+    for column in columns:
+        frame[column] = agg.format_timestamps(frame[column], time_format)
+    return frame
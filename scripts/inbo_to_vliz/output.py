@@ -0,0 +1,209 @@
+import gzip
+import os
+import shutil
+import sys
+import pandas as pd
+
+FORMATS = ['csv', 'parquet']
+COMPRESSIONS = ['none', 'gzip', 'zstd']
+PARTITIONS = ['transmitter', 'month']
+EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet', 'gzip': '.gz', 'zstd': '.zst', 'none': ''}
+# rows per to_csv call, so the csv text of a large frame is never in memory at once
+CSV_CHUNKSIZE = 100000
+
+def infer_format(path):
+    """Return the format and compression that match the extension of path"""
+    name = path.lower()
+    compression = 'none'
+    for candidate in ['gzip', 'zstd']:
+        if name.endswith(EXTENSIONS[candidate]):
+            compression = candidate
+            name = name[:-len(EXTENSIONS[candidate])]
+    return ('parquet' if name.endswith('.parquet') else 'csv'), compression
+
+def open_compressed(path, compression, mode='wb'):
+    if compression == 'gzip':
+        return gzip.open(path, mode)
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception('zstd compression needs the zstandard package')
+        # appending adds a frame, and concatenated frames are a valid zstd file
+        return zstandard.ZstdCompressor().stream_writer(open(path, mode))
+    return open(path, mode)
+
+def write_csv(detections, f, header=True, chunksize=CSV_CHUNKSIZE):
+    for start in range(0, len(detections), chunksize):
+        detections.iloc[start:start + chunksize].to_csv(f, header=header and start == 0, index=False)
+    if len(detections) == 0 and header:
+        detections.to_csv(f, index=False)
+
+class CsvWriter():
+    """Write frames to one csv file, or to stdout if path is '-', in chunks of CSV_CHUNKSIZE rows"""
+    def __init__(self, path, compression='none', formatter=None):
+        self.path = path
+        self.formatter = formatter
+        if path == '-':
+            self.f = sys.stdout
+        else:
+            self.f = open_compressed(path, compression, 'ab')
+        self.header = path == '-' or os.path.getsize(path) == 0
+
+    def write(self, frame):
+        if self.formatter:
+            frame = self.formatter(frame)
+        write_csv(frame, self.f, header=self.header)
+        self.header = False
+
+    def close(self):
+        if self.f is sys.stdout:
+            self.f.flush()
+        else:
+            self.f.close()
+
+class ParquetWriter():
+    """Write frames as row groups of one parquet file. Needs pyarrow."""
+    def __init__(self, path, compression='none'):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise Exception('parquet output needs the pyarrow package')
+        self.pyarrow = pyarrow
+        self.path = path
+        self.compression = {'none': 'NONE', 'gzip': 'GZIP', 'zstd': 'ZSTD'}[compression]
+        self.writer = None
+
+    def write(self, frame):
+        table = self.pyarrow.Table.from_pandas(frame, preserve_index=False)
+        if self.writer is None:
+            self.writer = self.pyarrow.parquet.ParquetWriter(self.path, table.schema, compression=self.compression)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+def partition_keys(frame, partition_by, time_column):
+    if partition_by == 'transmitter':
+        return frame['transmitter'].astype(object).fillna('unknown').astype(str).str.replace('/', '_').values
+    return pd.DatetimeIndex(frame[time_column]).strftime('%Y-%m')
+
+class PartitionedWriter():
+    """
+    Write frames to a directory with a subdirectory per transmitter or per month, named column=value so R (arrow's
+    open_dataset) and pyarrow read it as a partitioned dataset. Csv partitions are appended to, parquet partitions
+    get a new part file for every written frame, so no file has to stay open.
+    """
+    def __init__(self, directory, output_format, compression, partition_by, time_column, formatter=None):
+        self.directory = directory
+        self.output_format = output_format
+        self.compression = compression
+        self.partition_by = partition_by
+        self.time_column = time_column
+        self.formatter = formatter
+        self.parts = 0
+        if os.path.isdir(directory) and os.listdir(directory):
+            # csv partitions are appended to, so old partitions would end up in the output
+            raise Exception('Output directory {0} is not empty'.format(directory))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def partition_file(self, key):
+        directory = os.path.join(self.directory, '{0}={1}'.format(self.partition_by, key))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if self.output_format == 'csv':
+            name = 'part-00000.csv' + EXTENSIONS[self.compression]
+        else:
+            name = 'part-{0:05d}.parquet'.format(self.parts)
+        return os.path.join(directory, name)
+
+    def write(self, frame):
+        keys = partition_keys(frame, self.partition_by, self.time_column)
+        for key, part in frame.groupby(keys, sort=False):
+            if self.output_format == 'csv':
+                writer = CsvWriter(self.partition_file(key), self.compression, self.formatter)
+            else:
+                writer = ParquetWriter(self.partition_file(key), self.compression)
+            writer.write(part)
+            writer.close()
+        self.parts += 1
+
+    def close(self):
+        pass
+
+class SplitWriter():
+    """Write the rows of frames to the writer of their value in column, e.g. a file per threshold, without column"""
+    def __init__(self, column, writers):
+        self.column = column
+        self.writers = writers
+
+    def write(self, frame):
+        for value, writer in self.writers.items():
+            writer.write(frame[frame[self.column] == value].drop(self.column, axis=1))
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+def remove_output(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+class AtomicWriter():
+    """
+    Write to a temporary file or directory next to path and move it to path on close, so a reader of path sees the
+    previous output or the complete new one, never a partly written one
+    """
+    def __init__(self, path, open_temporary):
+        self.path = path
+        self.temporary = path + '.tmp'
+        # left behind by a write that failed
+        remove_output(self.temporary)
+        self.writer = open_temporary(self.temporary)
+
+    def write(self, frame):
+        self.writer.write(frame)
+
+    def close(self):
+        self.writer.close()
+        if not os.path.exists(self.temporary):
+            # a parquet file is only created by its first frame
+            return
+        if os.path.isdir(self.temporary):
+            # a directory can not replace another one in one rename, so the old one is moved away first
+            old = self.path + '.old'
+            remove_output(old)
+            if os.path.exists(self.path):
+                os.rename(self.path, old)
+            os.rename(self.temporary, self.path)
+            remove_output(old)
+        else:
+            os.rename(self.temporary, self.path)
+
+def open_writer(path='-', output_format=None, compression=None, partition_by=None, time_column='timestamp', formatter=None, atomic=False):
+    """
+    Return a writer with write(frame) and close() for path. Format and compression default to what the extension of
+    path says. formatter converts the frames to text columns for csv output; parquet keeps the original types. An
+    atomic writer replaces path on close, instead of writing to it directly.
+    """
+    inferred_format, inferred_compression = infer_format(path)
+    output_format = output_format or inferred_format
+    compression = compression or inferred_compression
+    if path == '-' and (output_format != 'csv' or compression != 'none' or partition_by or atomic):
+        raise Exception('Only uncompressed csv without partitions can be written to stdout')
+    if atomic:
+        return AtomicWriter(path, lambda temporary: open_writer(
+            temporary, output_format, compression, partition_by, time_column, formatter))
+    if partition_by:
+        return PartitionedWriter(path, output_format, compression, partition_by, time_column, formatter)
+    if os.path.exists(path):
+        # writers append, so start from an empty file
+        os.remove(path)
+    if output_format == 'parquet':
+        return ParquetWriter(path, compression)
+    return CsvWriter(path, compression, formatter)
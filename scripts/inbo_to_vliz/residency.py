@@ -0,0 +1,68 @@
+from network import interval_times
+from pandas.tseries.frequencies import to_offset
+import numpy as np
+import pandas as pd
+
+SUMMARY_COLUMNS = ['transmitter', 'stationname', 'bin', 'residence_seconds', 'intervals']
+
+def bin_seconds(size):
+    """Return the number of seconds of a fixed bin size such as 1D, 6H or 15min"""
+    nanos = to_offset(size).nanos
+    if nanos <= 0 or nanos % 10 ** 9 != 0:
+        raise ValueError('Bin size {0} is not a positive whole number of seconds'.format(size))
+    return nanos // 10 ** 9
+
+def split_intervals(intervals, seconds):
+    """
+    Split intervals at the boundaries of bins of seconds seconds, counted from 1970-01-01 so daily bins start at
+    midnight UTC. Returns the transmitter, station and bin number of every piece and the seconds it covers in its bin.
+    An interval that starts and stops at the same moment, one detection, is a piece of zero seconds.
+    """
+    starts = interval_times(intervals['start']).view('i8') // 10 ** 9
+    stops = interval_times(intervals['stop']).view('i8') // 10 ** 9
+    first_bins = starts // seconds
+    pieces = stops // seconds - first_bins + 1
+    interval = np.repeat(np.arange(len(starts)), pieces)
+    # number of the piece within its interval: 0, 1, ... pieces - 1
+    offsets = np.arange(len(interval)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    bins = first_bins[interval] + offsets
+    piece_starts = np.maximum(starts[interval], bins * seconds)
+    piece_stops = np.minimum(stops[interval], (bins + 1) * seconds)
+    return (intervals['transmitter'].astype(object).values[interval],
+            intervals['stationname'].astype(object).values[interval],
+            bins, piece_stops - piece_starts)
+
+def summarize(intervals, size='1D'):
+    """
+    Return the presence and residence time of every transmitter at every station per bin of size, as a sparse table:
+    a row for every transmitter, station and bin with at least one detection, with the start of the bin, the seconds
+    of residence in it and the number of intervals it overlaps.
+    """
+    seconds = bin_seconds(size)
+    transmitters, stations, bins, residence = split_intervals(intervals, seconds)
+    transmitter_codes, transmitter_names = pd.factorize(transmitters, sort=True)
+    station_codes, station_names = pd.factorize(stations, sort=True)
+    order = np.lexsort((bins, station_codes, transmitter_codes))
+    transmitter_codes, station_codes, bins, residence = (
+        transmitter_codes[order], station_codes[order], bins[order], residence[order])
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = ((transmitter_codes[1:] != transmitter_codes[:-1]) | (station_codes[1:] != station_codes[:-1]) |
+                 (bins[1:] != bins[:-1]))
+    groups = np.flatnonzero(first)
+    return pd.DataFrame(data={
+        'transmitter': transmitter_names.take(transmitter_codes[groups]),
+        'stationname': station_names.take(station_codes[groups]),
+        'bin': ((bins[groups] * seconds) * 10 ** 9).astype('datetime64[ns]'),
+        'residence_seconds': np.add.reduceat(residence, groups) if len(groups) > 0 else residence,
+        'intervals': np.diff(np.append(groups, len(order)))
+    }, columns=SUMMARY_COLUMNS)
+
+def total_residence(summary):
+    """Return the total residence time and the number of bins present of every transmitter at every station"""
+    grouped = summary.groupby(['transmitter', 'stationname'], sort=True)
+    return pd.DataFrame({
+        'residence_seconds': grouped['residence_seconds'].sum(),
+        'bins_present': grouped.size(),
+        'first_bin': grouped['bin'].min(),
+        'last_bin': grouped['bin'].max()
+    }, columns=['residence_seconds', 'bins_present', 'first_bin', 'last_bin']).reset_index()
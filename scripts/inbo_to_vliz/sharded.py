@@ -0,0 +1,155 @@
+from fish_tracking import Aggregator
+from multiprocessing import Pool
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import zlib
+import numpy as np
+import pandas as pd
+
+COLUMNS = ['timestamp', 'transmitter', 'stationname']
+INTERVAL_COLUMNS = ['start', 'stop', 'transmitter', 'stationname', 'minutes']
+
+def shard_numbers(transmitters, shards):
+    """Return the shard of every transmitter name: a hash that does not change between runs or processes"""
+    return np.array([(zlib.crc32(unicode(name).encode('utf-8')) & 0xffffffff) % shards for name in transmitters],
+                    dtype='i8')
+
+def save_columns(directory, columns):
+    """Spill a dict of numpy arrays to directory as .npy files, which the reader can memory-map"""
+    os.makedirs(directory)
+    for name, values in columns.items():
+        np.save(os.path.join(directory, name + '.npy'), values)
+
+def load_columns(directory):
+    return dict((name[:-len('.npy')], np.load(os.path.join(directory, name), mmap_mode='r'))
+                for name in os.listdir(directory) if name.endswith('.npy'))
+
+def write_shards(detections, directory, shards):
+    """
+    Hash-partition detections by transmitter into shards subdirectories of directory, as columns of timestamps and of
+    transmitter and station codes. The names behind the codes go to names.json. Detections keep their order within
+    a shard. Detections without transmitter are left out, they never end up in an interval.
+    """
+    transmitter_codes, transmitters = pd.factorize(detections['transmitter'])
+    station_codes, stations = pd.factorize(detections['stationname'])
+    with open(os.path.join(directory, 'names.json'), 'w') as f:
+        json.dump({'transmitter': list(transmitters), 'stationname': list(stations)}, f)
+    timestamps = detections['timestamp'].values
+    shard = shard_numbers(transmitters, shards)[transmitter_codes]
+    shard[transmitter_codes < 0] = shards
+    order = np.argsort(shard, kind='mergesort')
+    bounds = np.searchsorted(shard[order], np.arange(shards + 1))
+    paths = []
+    for number in range(shards):
+        positions = order[bounds[number]:bounds[number + 1]]
+        if len(positions) == 0:
+            continue
+        path = os.path.join(directory, 'shard-{0:04d}'.format(number))
+        save_columns(path, {
+            'timestamp': timestamps[positions],
+            'transmitter': transmitter_codes[positions].astype('i4'),
+            'stationname': station_codes[positions].astype('i4')
+        })
+        paths.append(path)
+    return paths
+
+def read_names(directory):
+    with open(os.path.join(directory, 'names.json')) as f:
+        names = json.load(f)
+    return dict((column, pd.Index(values, dtype=object)) for column, values in names.items())
+
+def aggregate_shard(task):
+    """
+    Aggregate the detections of one shard with Aggregator.aggregate and spill the intervals next to them, as start,
+    stop, transmitter and station code columns. Runs in a worker process, which gets only the settings of the
+    aggregation instead of the Aggregator of the caller, so it returns the metrics of the shard and the number of
+    isolated detections removed.
+    """
+    path, minutes_delta, isolation_window = task
+    agg = Aggregator(isolation_window=isolation_window)
+    names = read_names(os.path.dirname(path))
+    columns = load_columns(path)
+    detections = pd.DataFrame(data={
+        'timestamp': np.asarray(columns['timestamp']),
+        'transmitter': pd.Categorical.from_codes(np.asarray(columns['transmitter']), names['transmitter']),
+        'stationname': pd.Categorical.from_codes(np.asarray(columns['stationname']), names['stationname'])
+    }, columns=COLUMNS)
+    intervals = agg.aggregate(detections, minutes_delta=minutes_delta, time_format=None)
+    result = {
+        'start': intervals['start'].values,
+        'stop': intervals['stop'].values,
+        'transmitter': names['transmitter'].get_indexer(intervals['transmitter'].astype(object).values).astype('i4'),
+        'stationname': names['stationname'].get_indexer(intervals['stationname'].astype(object).values).astype('i4')
+    }
+    if 'minutes' in intervals:
+        result['minutes'] = intervals['minutes'].values
+    save_columns(os.path.join(path, 'intervals'), result)
+    return path, agg.metrics, agg.isolated_removed
+
+def merge_intervals(directory, paths):
+    """
+    Concatenate the intervals of the shards in paths in the order Aggregator.aggregate returns them: by threshold, if
+    there are several, and by transmitter. Shards have no transmitters in common, so the intervals of a transmitter
+    keep the order of their shard.
+    """
+    names = read_names(directory)
+    shards = [load_columns(os.path.join(path, 'intervals')) for path in paths]
+    if not shards:
+        return pd.DataFrame(data={
+            'start': pd.Series([], dtype='datetime64[ns]'),
+            'stop': pd.Series([], dtype='datetime64[ns]'),
+            'transmitter': pd.Series([], dtype=object),
+            'stationname': pd.Series([], dtype=object)
+        })
+    columns = [column for column in INTERVAL_COLUMNS if all(column in shard for shard in shards)]
+    merged = dict((column, np.concatenate([shard[column] for shard in shards])) for column in columns)
+    ranks = np.empty(len(names['transmitter']), dtype='i8')
+    ranks[np.argsort(names['transmitter'].values, kind='mergesort')] = np.arange(len(names['transmitter']))
+    keys = [ranks[merged['transmitter']]]
+    if 'minutes' in merged:
+        keys.append(merged['minutes'])
+    order = np.lexsort(keys)
+    intervals = pd.DataFrame(data={
+        'start': merged['start'][order],
+        'stop': merged['stop'][order],
+        'transmitter': names['transmitter'].take(merged['transmitter'][order]),
+        'stationname': names['stationname'].take(merged['stationname'][order])
+    })
+    if 'minutes' in merged:
+        intervals['minutes'] = merged['minutes'][order]
+    return intervals
+
+def sharded_aggregate(agg, detections, minutes_delta=30, shards=4, jobs=1, tmpdir=None):
+    """
+    Aggregate detections like Aggregator.aggregate(detections, minutes_delta, time_format=None), with the work split
+    over jobs processes. Intervals never span transmitters, so the detections are hash-partitioned by transmitter into
+    shards, spilled to disk as .npy columns that the workers memory-map instead of receiving them pickled, and the
+    intervals of the shards are merged back into the order of Aggregator.aggregate. More shards than jobs keeps the
+    workers busy when some transmitters have far more detections than others.
+    """
+    workdir = tempfile.mkdtemp(prefix='ft-shards-', dir=tmpdir)
+    pool = None
+    try:
+        with agg.metrics.stage('shard', rows_in=len(detections)):
+            paths = write_shards(detections, workdir, shards)
+        tasks = [(path, minutes_delta, agg.isolation_window) for path in paths]
+        if jobs > 1:
+            pool = Pool(jobs)
+            results = pool.imap_unordered(aggregate_shard, tasks)
+        else:
+            results = itertools.imap(aggregate_shard, tasks)
+        for path, shard_metrics, removed in results:
+            agg.metrics.merge(shard_metrics)
+            agg.isolated_removed += removed
+        with agg.metrics.stage('merge') as stage:
+            intervals = merge_intervals(workdir, paths)
+            stage.rows_out = len(intervals)
+        return intervals
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        shutil.rmtree(workdir)
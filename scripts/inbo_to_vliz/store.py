@@ -0,0 +1,158 @@
+from fish_tracking import Aggregator
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+
+# rows per executemany call while loading
+BATCH_SIZE = 100000
+# transmitters per query when detections are read back to aggregate them
+QUERY_TRANSMITTERS = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, path TEXT UNIQUE, fingerprint TEXT);
+CREATE TABLE IF NOT EXISTS detections (file_id INTEGER, timestamp INTEGER, transmitter TEXT, stationname TEXT, receiver TEXT);
+CREATE INDEX IF NOT EXISTS detections_transmitter ON detections (transmitter, timestamp);
+CREATE INDEX IF NOT EXISTS detections_stationname ON detections (stationname, timestamp);
+CREATE INDEX IF NOT EXISTS detections_file ON detections (file_id);
+CREATE TABLE IF NOT EXISTS intervals (start INTEGER, stop INTEGER, transmitter TEXT, stationname TEXT);
+CREATE INDEX IF NOT EXISTS intervals_transmitter ON intervals (transmitter, start);
+CREATE INDEX IF NOT EXISTS intervals_stationname ON intervals (stationname, start);
+CREATE TABLE IF NOT EXISTS pending (transmitter TEXT PRIMARY KEY);
+"""
+
+def epoch_seconds(timestamps):
+    values = np.asarray(timestamps)
+    if values.dtype.kind == 'M':
+        values = values.astype('datetime64[ns]').view('i8') // 10 ** 9
+    return values.astype('i8').tolist()
+
+def nullable(values):
+    """Column values as a list of python objects, with None for missing values"""
+    values = pd.Series(values).astype(object)
+    return values.where(values.notnull(), None).tolist()
+
+class DetectionStore():
+    """
+    SQLite database with the detections of every loaded file and the intervals they aggregate into. Loading a file
+    again replaces its detections, and the intervals of the transmitters it contains are aggregated again. Until they
+    are, these transmitters are kept in the pending table, so a load that is interrupted before the intervals are
+    updated leaves them to the next one.
+    """
+    def __init__(self, path, aggregator=None):
+        self.path = path
+        self.agg = aggregator or Aggregator()
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def fingerprint(self, path):
+        stat = os.stat(path)
+        return '{0}-{1!r}'.format(stat.st_size, stat.st_mtime)
+
+    def changed_files(self, paths):
+        """Return the paths that were not loaded yet or changed since they were"""
+        loaded = dict(self.connection.execute('SELECT path, fingerprint FROM files'))
+        return [path for path in paths if loaded.get(os.path.abspath(path)) != self.fingerprint(path)]
+
+    def load_file(self, path, detections):
+        """
+        Replace the detections of path by detections, in one transaction that also marks the transmitters whose
+        intervals have to be aggregated again as pending. Returns these transmitters.
+        """
+        path = os.path.abspath(path)
+        with self.connection:
+            cursor = self.connection.cursor()
+            cursor.execute('INSERT OR IGNORE INTO files (path) VALUES (?)', (path,))
+            cursor.execute('UPDATE files SET fingerprint = ? WHERE path = ?', (self.fingerprint(path), path))
+            file_id = cursor.execute('SELECT id FROM files WHERE path = ?', (path,)).fetchone()[0]
+            transmitters = set(row[0] for row in cursor.execute(
+                'SELECT DISTINCT transmitter FROM detections WHERE file_id = ?', (file_id,)))
+            cursor.execute('DELETE FROM detections WHERE file_id = ?', (file_id,))
+            for start in range(0, len(detections), BATCH_SIZE):
+                batch = detections.iloc[start:start + BATCH_SIZE]
+                cursor.executemany('INSERT INTO detections VALUES (?, ?, ?, ?, ?)', zip(
+                    [file_id] * len(batch),
+                    epoch_seconds(batch['timestamp']),
+                    nullable(batch['transmitter']),
+                    nullable(batch['stationname']),
+                    nullable(batch['receiver'])
+                ))
+            transmitters.update(detections['transmitter'].dropna().astype(object).unique())
+            cursor.executemany('INSERT OR IGNORE INTO pending VALUES (?)',
+                               [(transmitter,) for transmitter in transmitters if transmitter is not None])
+        return transmitters
+
+    def pending_transmitters(self):
+        """Return the transmitters of loaded files whose intervals were not aggregated again yet"""
+        return set(row[0] for row in self.connection.execute('SELECT transmitter FROM pending'))
+
+    def minutes_delta(self):
+        row = self.connection.execute("SELECT value FROM settings WHERE name = 'minutes_delta'").fetchone()
+        return int(row[0]) if row else None
+
+    def update_intervals(self, transmitters, minutes_delta=30):
+        """
+        Aggregate the stored detections of transmitters again, replace their intervals and remove them from the
+        pending transmitters. All intervals are aggregated again if the store was aggregated with another
+        minutes_delta before.
+        """
+        if self.minutes_delta() != minutes_delta:
+            transmitters = [row[0] for row in self.connection.execute(
+                'SELECT DISTINCT transmitter FROM detections WHERE transmitter IS NOT NULL')]
+            with self.connection:
+                self.connection.execute('DELETE FROM intervals')
+                self.connection.execute("INSERT OR REPLACE INTO settings VALUES ('minutes_delta', ?)", (str(minutes_delta),))
+        transmitters = sorted(transmitters)
+        for start in range(0, len(transmitters), QUERY_TRANSMITTERS):
+            selection = transmitters[start:start + QUERY_TRANSMITTERS]
+            placeholders = ', '.join('?' * len(selection))
+            detections = pd.read_sql_query(
+                'SELECT timestamp, transmitter, stationname FROM detections WHERE transmitter IN ({0})'.format(placeholders),
+                self.connection, params=selection)
+            intervals = self.agg.intervals(self.agg.sort_detections(detections), minutes_delta=minutes_delta)
+            with self.connection:
+                self.connection.execute('DELETE FROM intervals WHERE transmitter IN ({0})'.format(placeholders), selection)
+                self.connection.execute('DELETE FROM pending WHERE transmitter IN ({0})'.format(placeholders), selection)
+                self.connection.executemany('INSERT INTO intervals VALUES (?, ?, ?, ?)', zip(
+                    epoch_seconds(intervals['start']),
+                    epoch_seconds(intervals['stop']),
+                    nullable(intervals['transmitter']),
+                    nullable(intervals['stationname'])
+                ))
+
+    def query(self, table='detections', transmitters=None, stations=None, start=None, end=None):
+        """
+        Return the detections, or the intervals, of the given transmitters and stations between start and end (any
+        of them optional), sorted by transmitter and time. Intervals are returned if they overlap the time window.
+        """
+        if table == 'detections':
+            columns, first, last = 'timestamp, transmitter, stationname, receiver', 'timestamp', 'timestamp'
+        elif table == 'intervals':
+            columns, first, last = 'start, stop, transmitter, stationname', 'start', 'stop'
+        else:
+            raise Exception('Unknown table {0}'.format(table))
+        conditions, params = [], []
+        if transmitters:
+            conditions.append('transmitter IN ({0})'.format(', '.join('?' * len(transmitters))))
+            params.extend(transmitters)
+        if stations:
+            conditions.append('stationname IN ({0})'.format(', '.join('?' * len(stations))))
+            params.extend(stations)
+        if start is not None:
+            conditions.append('{0} >= ?'.format(last))
+            params.append(epoch_seconds([pd.Timestamp(start).to_datetime64()])[0])
+        if end is not None:
+            conditions.append('{0} <= ?'.format(first))
+            params.append(epoch_seconds([pd.Timestamp(end).to_datetime64()])[0])
+        sql = 'SELECT {0} FROM {1}'.format(columns, table)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY transmitter, {0}'.format(first)
+        result = pd.read_sql_query(sql, self.connection, params=params)
+        for column in [first, last]:
+            result[column] = pd.to_datetime(result[column], unit='s')
+        return result
@@ -0,0 +1,141 @@
+from fish_tracking import timestamps_ns
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# maximum plausible swim speed in m/s for transmitters of species without a speed of their own
+DEFAULT_MAX_SPEED = 2.0
+FLAG_COLUMN = 'implausible_speed'
+
+class DistanceMatrix():
+    """
+    Distances in meters between stations, from a distancematrix_*.csv of receiver_distance_analysis/results. If
+    cache_dir is given, the matrix is stored there as a .npy file the first time and memory-mapped afterwards, so
+    large matrices are not parsed again and only the pages that are looked up are read.
+    """
+    def __init__(self, path, cache_dir=None):
+        self.path = path
+        if cache_dir:
+            self.stations, self.values = self.cached(cache_dir)
+        else:
+            self.stations, self.values = self.read()
+
+    def read(self):
+        matrix = pd.read_csv(self.path, index_col=0)
+        if list(matrix.index) != list(matrix.columns):
+            raise Exception('Rows and columns of {0} are not the same stations'.format(self.path))
+        return pd.Index(matrix.index.astype(str)), matrix.values.astype('f8')
+
+    def cached(self, cache_dir):
+        stat = os.stat(self.path)
+        key = hashlib.sha1('{0}-{1}-{2!r}'.format(os.path.abspath(self.path), stat.st_size, stat.st_mtime)).hexdigest()
+        values_file = os.path.join(cache_dir, key + '.npy')
+        stations_file = os.path.join(cache_dir, key + '.json')
+        if not os.path.exists(values_file):
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            stations, values = self.read()
+            with open(stations_file, 'w') as f:
+                json.dump(list(stations), f)
+            np.save(values_file + '.tmp.npy', values)
+            os.rename(values_file + '.tmp.npy', values_file)
+        with open(stations_file) as f:
+            stations = pd.Index(json.load(f))
+        return stations, np.load(values_file, mmap_mode='r')
+
+    def lookup(self, from_stations, to_stations):
+        """Return the distances between two arrays of station names, NaN where a station is not in the matrix"""
+        rows = self.stations.get_indexer(np.asarray(from_stations, dtype=object))
+        columns = self.stations.get_indexer(np.asarray(to_stations, dtype=object))
+        known = (rows >= 0) & (columns >= 0)
+        distances = np.empty(len(rows))
+        distances.fill(np.nan)
+        distances[known] = self.values[rows[known], columns[known]]
+        return distances
+
+def read_species(path):
+    """Return a Series of species by transmitter from a csv file with transmitter and species columns"""
+    tags = pd.read_csv(path, dtype=str)
+    return tags.set_index('transmitter')['species']
+
+class SpeedFilter():
+    """
+    Flag moves between stations that imply a swim speed above the maximum of the species of the transmitter. A move is
+    a change of station between consecutive rows of a transmitter, and its speed is the distance between the stations
+    divided by the time between leaving the first and arriving at the second. The arriving row is flagged. Moves
+    between stations that are not in the distance matrix are never flagged.
+
+    filter_sorted can be called repeatedly with consecutive chunks of one stream sorted by transmitter and time: the
+    last row of a chunk is kept to check the first move of the next one. Every row is checked against the row before
+    it, also when that row is dropped itself.
+    """
+    def __init__(self, matrix, max_speed=DEFAULT_MAX_SPEED, species=None, species_speeds=None, drop=False):
+        self.matrix = matrix
+        self.max_speed = max_speed
+        self.species = species if species is not None else pd.Series([], dtype=object)
+        self.species_speeds = species_speeds or {}
+        self.drop = drop
+        self.last = None
+        self.flagged = 0
+
+    def max_speeds(self, transmitters):
+        species = self.species.reindex(np.asarray(transmitters, dtype=object)).values
+        speeds = pd.Series(species).map(pd.Series(self.species_speeds, dtype='f8')).values
+        return np.where(np.isnan(speeds), self.max_speed, speeds)
+
+    def implausible(self, transmitters, stations, arrivals, departures):
+        """Return a mask of the rows whose arrival is too fast after the departure from the station of the row before"""
+        moved = (transmitters[1:] == transmitters[:-1]) & (stations[1:] != stations[:-1])
+        moved &= pd.notnull(stations[1:]) & pd.notnull(stations[:-1])
+        moves = np.flatnonzero(moved)
+        distances = self.matrix.lookup(stations[moves], stations[moves + 1])
+        seconds = (arrivals[moves + 1] - departures[moves]).astype('timedelta64[s]').astype('f8')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speeds = np.where(seconds > 0, distances / seconds, np.where(distances > 0, np.inf, 0.0))
+        too_fast = speeds > self.max_speeds(transmitters[moves + 1])
+        implausible = np.zeros(len(transmitters), dtype=bool)
+        implausible[moves[too_fast] + 1] = True
+        return implausible
+
+    def columns(self, frame):
+        """Arrival and departure columns: start and stop of intervals, or the timestamp of detections"""
+        if 'start' in frame:
+            return frame['start'].values, frame['stop'].values
+        timestamps = timestamps_ns(frame)
+        return timestamps, timestamps
+
+    def apply(self, frame, implausible):
+        self.flagged += implausible.sum()
+        if self.drop:
+            return frame[~implausible]
+        return frame.assign(**{FLAG_COLUMN: implausible})
+
+    def filter_sorted(self, frame):
+        """Flag or drop the implausible moves in frame, which is sorted by transmitter and time"""
+        if len(frame) == 0:
+            return frame
+        arrivals, departures = self.columns(frame)
+        transmitters = frame['transmitter'].astype(object).values
+        stations = frame['stationname'].astype(object).values
+        if self.last is not None:
+            transmitters = np.concatenate([self.last[0], transmitters])
+            stations = np.concatenate([self.last[1], stations])
+            arrivals = np.concatenate([self.last[2], arrivals])
+            departures = np.concatenate([self.last[3], departures])
+        implausible = self.implausible(transmitters, stations, arrivals, departures)
+        if self.last is not None:
+            implausible = implausible[1:]
+        self.last = (transmitters[-1:], stations[-1:], arrivals[-1:], departures[-1:])
+        return self.apply(frame, implausible)
+
+    def filter(self, frame, agg):
+        """Flag or drop the implausible moves in frame, which can be in any order, and keep the order of frame"""
+        arrivals, departures = self.columns(frame)
+        order = agg.sort_order(frame['transmitter'], arrivals)
+        implausible = np.zeros(len(frame), dtype=bool)
+        implausible[order] = self.implausible(frame['transmitter'].astype(object).values[order],
+                                              frame['stationname'].astype(object).values[order],
+                                              arrivals[order], departures[order])
+        return self.apply(frame, implausible)
@@ -1,8 +1,31 @@
 import unittest
+import bz2
+import gzip
 import os
+import zipfile
+import shutil
+import tempfile
+import time
+import click
+import numpy as np
 import pandas as pd
 from datetime import datetime
-from fish_tracking import Aggregator
+from fish_tracking import Aggregator, StationMapper, DetectionFormat, DETECTION_FORMATS, register_format
+from ft_cli import read_detections, stream_detections
+from cache import DetectionCache
+from store import DetectionStore
+from dedup import Deduplicator
+from timer import Metrics
+from swimspeed import DistanceMatrix, SpeedFilter
+import network
+import residency
+from watch import DirectoryWatcher
+from incremental import IncrementalAggregator, sort_intervals
+import external
+import sharded
+import benchmark
+import output
+import compressed
 
 
 # Locate test files
@@ -11,6 +34,7 @@ VLIZ_2_DETECTIONS = os.path.dirname(os.path.realpath(__file__)) + '/example-file
 INBO_DETECTIONS = os.path.dirname(os.path.realpath(__file__)) + '/example-files/VR2W_INBO_example.csv'
 VUE_DETECTIONS = os.path.dirname(os.path.realpath(__file__)) + '/example-files/VUE_export_example.csv'
 STATION_MAPPING = os.path.dirname(os.path.realpath(__file__)) + '/example-files/station_names.csv'
+DISTANCE_MATRIX = os.path.dirname(os.path.realpath(__file__)) + '/../receiver_distance_analysis/results/distancematrix_2004_gudena.csv'
 
 class TestAggregator(unittest.TestCase):
 
@@ -32,6 +56,36 @@ class TestAggregator(unittest.TestCase):
         test_station_names = pd.Series(['some-5', 'not ok'])
         self.assertFalse(self.agg.check_stationnames(test_station_names, None))
 
+    def test_parse_timestamps(self):
+        timestamps = self.agg.parse_timestamps(
+            pd.Series(['05/11/2014 06:15', '20/01/2015 20:44']),
+            ['%Y-%m-%d %H:%M:%S', '%d/%m/%Y %H:%M']
+        )
+        self.assertEquals(str(timestamps.dtype), 'datetime64[ns]')
+        self.assertEquals(list(timestamps), [datetime(2014, 11, 5, 6, 15), datetime(2015, 1, 20, 20, 44)])
+
+    def test_parse_timestamps_invalid_rows(self):
+        """A row that does not match the detected format is reported instead of silently coerced"""
+        with self.assertRaises(Exception) as context:
+            self.agg.parse_timestamps(
+                pd.Series(['2015-01-01 10:42:29', '2015-01-01 10:43', '2015-01-01 10:44:29']),
+                ['%Y-%m-%d %H:%M:%S']
+            )
+        self.assertIn('row 1', str(context.exception))
+
+    def test_station_mapper(self):
+        mapper = StationMapper(STATION_MAPPING)
+        mapped = mapper.map(pd.Series(['VG-2', 's-8-1', 'VR2W-122324', 'ok-1', None]))
+        self.assertEquals(list(mapped[:4]), ['bpns-VG2', 's-8', 'ma-3', 'ok-1'])
+        self.assertEquals(list(mapper.valid(mapped)), [True, True, True, True, False])
+
+    def test_parse_detections_shared_station_mapper(self):
+        """A StationMapper instance can be passed instead of the path of the mapping file"""
+        mapper = StationMapper(STATION_MAPPING)
+        detections = self.agg.parse_detections(VLIZ_DETECTIONS, station_mapping=mapper)
+        self.assertEquals(detections['stationname'][0], 'bpns-VG2')
+        self.assertIn('VG-2', mapper.lookup)
+
     # @unittest.SkipTest
     def test_parse_vliz_detections(self):
         detections = self.agg.parse_detections(VLIZ_DETECTIONS)
@@ -62,6 +116,40 @@ class TestAggregator(unittest.TestCase):
         self.assertEquals(detections['stationname'].iloc[-1], 'ma-3')
 
 
+    def test_iter_detections(self):
+        """Streaming a file in chunks gives the same detections as parsing it at once"""
+        chunks = list(self.agg.iter_detections(INBO_DETECTIONS, station_mapping=STATION_MAPPING, chunksize=6))
+        self.assertEquals([len(chunk) for chunk in chunks], [6, 6, 6, 2])
+        expected = self.agg.parse_detections(INBO_DETECTIONS, station_mapping=STATION_MAPPING)
+        self.assertTrue(pd.concat(chunks).equals(expected))
+
+    def test_parse_detections_reads_needed_columns(self):
+        detections = self.agg.parse_detections(VUE_DETECTIONS)
+        self.assertEquals(str(detections['transmitter'].dtype), 'category')
+
+    def test_register_format(self):
+        """New export layouts are added to the registry without changing parse_detections"""
+        def parse_custom(agg, dataframe, station_mapping=None):
+            return pd.DataFrame(data={
+                'timestamp': agg.parse_timestamps(dataframe['when'], ['%Y-%m-%d %H:%M:%S']),
+                'transmitter': dataframe['tag'],
+                'stationname': agg.map_stationnames(dataframe['station'], station_mapping),
+                'receiver': dataframe['station']
+            })
+        custom_format = DetectionFormat('custom', ['when', 'tag', 'station', 'depth'], ['when', 'tag', 'station'],
+                                        {'when': str, 'tag': str, 'station': str}, parse_custom)
+        register_format(custom_format)
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'custom.csv')
+            with open(path, 'w') as f:
+                f.write('tag;when;station;depth\nA69-1601-1;2015-01-01 10:00:00;VG-2;4.2\n'.replace(';', '\t'))
+            detections = self.agg.parse_detections(path, station_mapping=STATION_MAPPING)
+            self.assertEquals(list(detections['stationname']), ['bpns-VG2'])
+        finally:
+            shutil.rmtree(directory)
+            del DETECTION_FORMATS[tuple(sorted(custom_format.columns))]
+
     # @unittest.SkipTest
     def test_fail_parse_vliz_detections(self):
         failing_data = [
@@ -311,4 +399,690 @@ class TestAggregator(unittest.TestCase):
             ['1420111800', 'vr1', '1420111800', 'id1']
         ]
         for i, row in result_sorted.iterrows():
-            self.assertEquals(list(row), expected_output[i])
\ No newline at end of file
+            self.assertEquals(list(row), expected_output[i])
+
+    def test_aggregate_iso_format(self):
+        indata = pd.DataFrame(
+            data={
+                'timestamp': [
+                    datetime(2015, 1, 1, 10, 30, 10),
+                    datetime(2015, 1, 1, 10, 50, 00),
+                    datetime(2015, 1, 1, 11, 30, 00)
+                ],
+                'transmitter': ['id1', 'id1', 'id1'],
+                'stationname': ['vr1', 'vr1', 'vr1']
+            }
+        )
+        result = self.agg.aggregate(indata, minutes_delta=30, time_format='iso')
+        self.assertEquals(list(result.iloc[0]), ['2015-01-01T10:30:10', 'vr1', '2015-01-01T10:50:00', 'id1'])
+        self.assertEquals(list(result.iloc[1]), ['2015-01-01T11:30:00', 'vr1', '2015-01-01T11:30:00', 'id1'])
+
+
+    def test_compact_detections(self):
+        vliz = self.agg.compact_detections(self.agg.parse_detections(VLIZ_DETECTIONS))
+        vliz_2 = self.agg.compact_detections(self.agg.parse_detections(VLIZ_2_DETECTIONS))
+        self.assertEquals(str(vliz['timestamp'].dtype), 'int64')
+        self.assertEquals(vliz['timestamp'].iloc[0], 1423767691)
+        # both files share the transmitter dictionary
+        self.assertEquals(list(vliz_2['transmitter'].cat.categories[:2]), list(vliz['transmitter'].cat.categories))
+        detections = self.agg.concat_detections([vliz, vliz_2])
+        self.assertEquals(str(detections['transmitter'].dtype), 'category')
+        self.assertEquals(str(detections['stationname'].dtype), 'category')
+        report = self.agg.memory_report(detections)
+        self.assertEquals(report.loc['total', 'bytes'], detections.memory_usage(index=True, deep=True).sum())
+
+    def test_aggregate_compact_detections(self):
+        """Compacted detections give the same intervals"""
+        detections = self.agg.parse_detections(VUE_DETECTIONS)
+        expected = self.agg.aggregate(detections, minutes_delta=30)
+        result = self.agg.aggregate(self.agg.compact_detections(detections), minutes_delta=30)
+        self.assertTrue((result.values == expected.values).all())
+
+    def test_sort_order_categories(self):
+        """Categories in the order they were first seen sort by transmitter name"""
+        transmitters = pd.Series(pd.Categorical(['b', 'a', None, 'c', 'a'], categories=['c', 'b', 'a']))
+        timestamps = pd.to_datetime(['2015-01-01'] * 5).values
+        self.assertEquals(list(self.agg.sort_order(transmitters, timestamps)),
+                          list(self.agg.sort_order(transmitters.astype(object), timestamps)))
+        self.assertEquals(list(self.agg.sort_order(transmitters, timestamps)), [1, 4, 0, 3, 2])
+
+    def test_filter_isolated(self):
+        detections = pd.DataFrame(data={
+            'timestamp': pd.to_datetime(['2015-01-01 10:00', '2015-01-01 10:05', '2015-01-01 12:00',
+                                         '2015-01-01 10:01', '2015-01-01 10:02', '2015-01-01 10:03']),
+            'transmitter': ['A', 'A', 'A', 'A', 'B', None],
+            'stationname': ['s-1', 's-1', 's-1', 's-2', 's-1', 's-1']
+        })
+        filtered = self.agg.filter_isolated(detections, window=600)
+        # the detection at 12:00 is too late, the one at s-2 and the one of B are alone
+        self.assertEquals(list(filtered.index), [0, 1, 5])
+        self.assertEquals(self.agg.isolated_removed, 3)
+        compact = self.agg.filter_isolated(self.agg.compact_detections(detections), window=600)
+        self.assertEquals(list(compact.index), [0, 1, 5])
+
+    def test_aggregate_without_isolated(self):
+        detections = self.agg.parse_detections(VUE_DETECTIONS, STATION_MAPPING)
+        agg = Aggregator(isolation_window=600)
+        intervals = agg.aggregate(detections, minutes_delta=30)
+        expected = self.agg.aggregate(self.agg.filter_isolated(detections, 600), minutes_delta=30)
+        self.assertTrue(intervals.equals(expected))
+        self.assertEquals(agg.isolated_removed, self.agg.isolated_removed)
+
+    def test_aggregate_several_thresholds(self):
+        """Aggregating for several thresholds at once gives the intervals of each threshold, with its minutes"""
+        detections = self.agg.parse_detections(VUE_DETECTIONS, STATION_MAPPING)
+        result = self.agg.aggregate(detections, minutes_delta=[10, 60], time_format=None)
+        for minutes in [10, 60]:
+            intervals = result[result['minutes'] == minutes].drop('minutes', axis=1)
+            intervals.index = pd.Index(range(len(intervals)))
+            expected = self.agg.aggregate(detections, minutes_delta=minutes, time_format=None)
+            self.assertTrue(intervals.equals(expected))
+        compact = self.agg.aggregate(self.agg.compact_detections(detections), minutes_delta=[10, 60], time_format=None)
+        columns = {'transmitter': object, 'stationname': object}
+        self.assertTrue(compact.astype(columns).equals(result.astype(columns)))
+
+    def test_stage_metrics(self):
+        """Every stage adds its rows to the metrics of the Aggregator"""
+        detections = self.agg.parse_detections(VUE_DETECTIONS, STATION_MAPPING)
+        intervals = self.agg.aggregate(detections, minutes_delta=30)
+        report = dict((stage['stage'], stage) for stage in self.agg.metrics.report())
+        self.assertEquals(report['read']['rows_out'], len(detections))
+        self.assertEquals(report['parse_timestamps']['rows_in'], len(detections))
+        self.assertEquals(report['map_stationnames']['calls'], 1)
+        self.assertEquals(report['sort']['rows_in'], len(detections))
+        self.assertEquals(report['group']['rows_out'], len(intervals))
+        self.assertEquals(report['format']['rows_out'], len(intervals))
+
+    def test_nested_stages(self):
+        """A stage within another one is left out of its time, and its peak memory is part of the outer peak"""
+        metrics = Metrics()
+        with metrics.stage('write'):
+            time.sleep(0.05)
+            with metrics.stage('format'):
+                time.sleep(0.1)
+                allocated = np.ones(50 * 1024 * 1024 // 8)
+                del allocated
+        report = dict((stage['stage'], stage) for stage in metrics.report())
+        self.assertTrue(report['format']['seconds'] >= 0.1)
+        self.assertTrue(report['write']['seconds'] < 0.1)
+        self.assertTrue(report['write']['peak_rss_mb'] >= report['format']['peak_rss_mb'])
+
+
+class TestReadDetections(unittest.TestCase):
+
+    def setUp(self):
+        self.agg = Aggregator()
+        self.directory = tempfile.mkdtemp()
+        for path in [VLIZ_DETECTIONS, INBO_DETECTIONS, VUE_DETECTIONS]:
+            shutil.copy(path, self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_parallel_matches_sequential(self):
+        sequential = read_detections(self.agg, self.directory, STATION_MAPPING)
+        parallel = read_detections(self.agg, self.directory, STATION_MAPPING, jobs=3)
+        self.assertTrue(sequential.equals(parallel))
+
+    def test_failing_file_is_reported(self):
+        with open(os.path.join(self.directory, 'unknown.csv'), 'w') as f:
+            f.write('a,b\n1,2\n')
+        with self.assertRaises(click.ClickException):
+            read_detections(self.agg, self.directory, STATION_MAPPING, jobs=2)
+
+    def test_compressed_files(self):
+        """gzip, bz2 and zipped files are read like the plain csv files they contain"""
+        expected = read_detections(self.agg, self.directory, STATION_MAPPING)
+        with open(VLIZ_DETECTIONS, 'rb') as f:
+            content = f.read()
+        os.remove(os.path.join(self.directory, 'VR2W_VLIZ_example.csv'))
+        with gzip.open(os.path.join(self.directory, 'VR2W_VLIZ_example.csv.gz'), 'wb') as f:
+            f.write(content)
+        with open(INBO_DETECTIONS, 'rb') as f:
+            content = f.read()
+        os.remove(os.path.join(self.directory, 'VR2W_INBO_example.csv'))
+        with open(os.path.join(self.directory, 'VR2W_INBO_example.csv.bz2'), 'wb') as f:
+            f.write(bz2.compress(content))
+        os.rename(os.path.join(self.directory, 'VUE_export_example.csv'), os.path.join(self.directory, 'VUE_export_example.csv.tmp'))
+        archive = zipfile.ZipFile(os.path.join(self.directory, 'VUE_export_example.zip'), 'w')
+        archive.write(os.path.join(self.directory, 'VUE_export_example.csv.tmp'), 'VUE_export_example.csv')
+        archive.close()
+        os.remove(os.path.join(self.directory, 'VUE_export_example.csv.tmp'))
+        self.assertTrue(read_detections(self.agg, self.directory, STATION_MAPPING).equals(expected))
+
+    def write_invalid_rows(self):
+        """Give the VUE file an invalid station name on line 3, timestamp on line 5 and transmitter on line 7"""
+        path = os.path.join(self.directory, 'VUE_export_example.csv')
+        with open(path) as f:
+            lines = f.read().split('\n')
+        lines[2] = lines[2].replace('ws-18', 'bad_name')
+        lines[4] = '1970-13-45 99:00:00' + lines[4][lines[4].index(','):]
+        lines[6] = lines[6].replace('A69-1601-13631', '')
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines))
+        return path
+
+    def test_quarantine(self):
+        """Invalid rows are quarantined with their file and line, and the valid rows of the file are kept"""
+        expected = read_detections(self.agg, self.directory, STATION_MAPPING)
+        path = self.write_invalid_rows()
+        with open(os.path.join(self.directory, 'unknown.csv'), 'w') as f:
+            f.write('a,b\n1,2\n')
+        self.assertRaises(click.ClickException, read_detections, self.agg, self.directory, STATION_MAPPING)
+        agg = Aggregator(quarantine=True)
+        detections = read_detections(agg, self.directory, STATION_MAPPING, jobs=2)
+        self.assertEquals(len(detections), len(expected) - 3)
+        rejected = agg.rejected_rows()
+        self.assertEquals(list(rejected['file']), [path, path, path, os.path.join(self.directory, 'unknown.csv')])
+        self.assertEquals(list(rejected['line'][:3]), [3, 5, 7])
+        self.assertEquals(list(rejected['reason'][:3]), ['invalid station name', 'invalid timestamp', 'missing transmitter'])
+        self.assertTrue(pd.isnull(rejected['line'][3]))
+
+    def test_quarantine_chunks(self):
+        """Line numbers continue across chunks"""
+        path = self.write_invalid_rows()
+        agg = Aggregator(quarantine=True)
+        chunks = list(agg.iter_detections(path, STATION_MAPPING, chunksize=4))
+        self.assertEquals(sum(len(chunk) for chunk in chunks), len(pd.read_csv(path)) - 3)
+        self.assertEquals(list(agg.rejected_rows()['line']), [3, 5, 7])
+
+    def test_quarantine_stream(self):
+        """A file that fails after some of its chunks are parsed leaves none of them in the output"""
+        agg = Aggregator(quarantine=True)
+        iter_detections = agg.iter_detections
+        def failing_iter_detections(path, **kwargs):
+            for number, chunk in enumerate(iter_detections(path, **kwargs)):
+                if number == 2 and path.endswith('VR2W_VLIZ_example.csv'):
+                    raise ValueError('truncated file')
+                yield chunk
+        agg.iter_detections = failing_iter_detections
+        frames = []
+        class Writer():
+            def write(self, frame):
+                frames.append(frame)
+        stream_detections(agg, self.directory, STATION_MAPPING, 3, Writer())
+        os.remove(os.path.join(self.directory, 'VR2W_VLIZ_example.csv'))
+        expected = read_detections(self.agg, self.directory, STATION_MAPPING)
+        self.assertEquals(sum(len(frame) for frame in frames), len(expected))
+        self.assertEquals(list(agg.rejected_rows()['reason']), ['ValueError: truncated file'])
+
+    def test_prefetch_reader_lines(self):
+        compressed.BLOCK_SIZE, block_size = 7, compressed.BLOCK_SIZE
+        try:
+            with compressed.PrefetchReader(open(VUE_DETECTIONS, 'rb')) as f:
+                lines = list(f)
+        finally:
+            compressed.BLOCK_SIZE = block_size
+        with open(VUE_DETECTIONS, 'rb') as f:
+            self.assertEquals(lines, list(f))
+
+
+
+class TestDetectionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.agg = Aggregator()
+        self.directory = tempfile.mkdtemp()
+        self.cache = DetectionCache(os.path.join(self.directory, 'cache'))
+        self.path = os.path.join(self.directory, 'detections.csv')
+        shutil.copy(VLIZ_DETECTIONS, self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cache_roundtrip(self):
+        self.assertIsNone(self.cache.get(self.path, STATION_MAPPING))
+        detections = self.agg.parse_detections(self.path, station_mapping=STATION_MAPPING)
+        self.cache.put(self.path, STATION_MAPPING, detections)
+        self.assertTrue(self.cache.get(self.path, STATION_MAPPING).equals(detections))
+        self.assertEquals(self.cache.stats()['entries'], 1)
+
+    def test_cache_invalidation(self):
+        detections = self.agg.parse_detections(self.path)
+        self.cache.put(self.path, None, detections)
+        # another station mapping gives other detections
+        self.assertIsNone(self.cache.get(self.path, STATION_MAPPING))
+        # so does a changed input file
+        os.utime(self.path, (0, 0))
+        self.assertIsNone(self.cache.get(self.path, None))
+        self.cache.put(self.path, None, detections)
+        self.assertEquals(self.cache.stats()['entries'], 1)
+
+    def test_cache_eviction(self):
+        detections = self.agg.parse_detections(self.path)
+        self.cache.put(self.path, None, detections)
+        self.cache.max_size = 0
+        self.assertEquals(len(self.cache.evict()), 1)
+        self.assertEquals(self.cache.stats()['entries'], 0)
+
+
+
+class TestIncrementalAggregator(unittest.TestCase):
+
+    def setUp(self):
+        self.agg = Aggregator()
+        self.directory = tempfile.mkdtemp()
+        self.detections = pd.DataFrame(
+            data={
+                'timestamp': [
+                    datetime(2015, 1, 1, 10, 30, 10),
+                    datetime(2015, 1, 1, 10, 40, 00),
+                    datetime(2015, 1, 1, 10, 50, 00),
+                    datetime(2015, 1, 1, 11, 10, 00),
+                    datetime(2015, 1, 1, 11, 30, 00),
+                    datetime(2015, 1, 1, 11, 00, 00)
+                ],
+                'transmitter': ['id1', 'id2', 'id1', 'id1', 'id1', 'id2'],
+                'stationname': ['vr1', 'vr1', 'vr1', 'vr2', 'vr2', 'vr1']
+            }
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def update(self, incremental, name, detections):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(name)
+        return incremental.update({path: detections})
+
+    def full_aggregation(self, detections):
+        return sort_intervals(self.agg.intervals(self.agg.sort_detections(detections), minutes_delta=30))
+
+    def test_in_order_detections(self):
+        incremental = IncrementalAggregator(os.path.join(self.directory, 'state'), self.agg, minutes_delta=30)
+        self.update(incremental, 'first.csv', self.detections.iloc[:3])
+        changed = self.update(incremental, 'second.csv', self.detections.iloc[3:])
+        self.assertTrue(incremental.intervals().equals(self.full_aggregation(self.detections)))
+        # id1 moved to another station, so its open interval is left as it was; the one of id2 is continued
+        self.assertEquals(list(changed['transmitter']), ['id1', 'id2'])
+        self.assertEquals(list(changed['start']), [datetime(2015, 1, 1, 11, 10), datetime(2015, 1, 1, 10, 40)])
+        self.assertEquals(list(changed['stop']), [datetime(2015, 1, 1, 11, 30), datetime(2015, 1, 1, 11, 00)])
+
+    def test_out_of_order_detections(self):
+        state = os.path.join(self.directory, 'state')
+        self.update(IncrementalAggregator(state, self.agg, minutes_delta=30), 'late.csv', self.detections.iloc[[0, 2, 4]])
+        self.update(IncrementalAggregator(state, self.agg, minutes_delta=30), 'early.csv', self.detections.iloc[[1, 3, 5]])
+        result = IncrementalAggregator(state, self.agg, minutes_delta=30).intervals()
+        self.assertTrue(result.equals(self.full_aggregation(self.detections)))
+
+    def test_changed_files(self):
+        incremental = IncrementalAggregator(os.path.join(self.directory, 'state'), self.agg, minutes_delta=30)
+        self.update(incremental, 'first.csv', self.detections)
+        path = os.path.join(self.directory, 'first.csv')
+        self.assertEquals(incremental.changed_files([path]), [])
+        os.utime(path, (0, 0))
+        self.assertEquals(incremental.changed_files([path]), [path])
+
+    def test_watcher_ready_files(self):
+        incremental = IncrementalAggregator(os.path.join(self.directory, 'state'), self.agg, minutes_delta=30)
+        self.update(incremental, 'ingested.csv', self.detections)
+        paths = [os.path.join(self.directory, name) for name in ['ingested.csv', 'old.csv', 'new.csv', 'broken.csv']]
+        for path, mtime in zip(paths[1:], [100, 200, 50]):
+            with open(path, 'w') as f:
+                f.write('detections')
+            os.utime(path, (mtime, mtime))
+        watcher = DirectoryWatcher(incremental, settle=30, batch_size=2)
+        watcher.fail(paths[3])
+        # new.csv was modified 10 seconds ago, so it may still be copied
+        self.assertEquals(watcher.ready(paths, now=210), [paths[1]])
+        self.assertEquals(watcher.ready(paths, now=300), [paths[1], paths[2]])
+        os.utime(paths[3], (60, 60))
+        self.assertEquals(watcher.ready(paths, now=300), [paths[3], paths[1]])
+        # a file that is moved away is skipped
+        os.remove(paths[3])
+        self.assertEquals(watcher.ready(paths, now=300), [paths[1], paths[2]])
+
+
+
+class TestExternalAggregation(unittest.TestCase):
+
+    def setUp(self):
+        self.agg = Aggregator()
+        self.paths = [VLIZ_DETECTIONS, VLIZ_2_DETECTIONS, INBO_DETECTIONS, VUE_DETECTIONS]
+        detections = pd.concat([self.agg.parse_detections(path, STATION_MAPPING) for path in self.paths])
+        self.expected = self.agg.aggregate(detections, minutes_delta=30)
+
+    def external_aggregate(self):
+        intervals = pd.concat(list(external.external_aggregate(self.agg, self.paths, STATION_MAPPING, minutes_delta=30, chunksize=3)))
+        intervals.index = self.expected.index
+        return self.agg.format_intervals(intervals)
+
+    def test_external_aggregate(self):
+        self.assertTrue(self.external_aggregate().equals(self.expected))
+
+    def test_multi_pass_merge(self):
+        """With more runs than MAX_FANIN, runs are first merged into longer runs"""
+        max_fanin, block_size = external.MAX_FANIN, external.BLOCK_SIZE
+        external.MAX_FANIN, external.BLOCK_SIZE = 3, 2
+        try:
+            self.assertTrue(self.external_aggregate().equals(self.expected))
+        finally:
+            external.MAX_FANIN, external.BLOCK_SIZE = max_fanin, block_size
+
+    def test_file_error(self):
+        """A file that fails halfway is left out, also the chunks parsed before the error"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            broken = os.path.join(tmpdir, 'broken.csv')
+            with open(VLIZ_DETECTIONS) as f:
+                lines = f.readlines()
+            lines[8] = lines[8].replace('2015-02-12', '2015-13-12')
+            with open(broken, 'w') as f:
+                f.writelines(lines)
+            errors = []
+            intervals = pd.concat(list(external.external_aggregate(
+                self.agg, self.paths[1:] + [broken], STATION_MAPPING, minutes_delta=30, chunksize=3,
+                on_error=lambda path, e: errors.append(path))))
+            self.assertEquals(errors, [broken])
+            detections = pd.concat([self.agg.parse_detections(path, STATION_MAPPING) for path in self.paths[1:]])
+            expected = self.agg.aggregate(detections, minutes_delta=30)
+            intervals.index = expected.index
+            self.assertTrue(self.agg.format_intervals(intervals).equals(expected))
+            with self.assertRaises(Exception):
+                list(external.external_aggregate(self.agg, [broken], STATION_MAPPING, chunksize=3))
+        finally:
+            shutil.rmtree(tmpdir)
+
+class TestShardedAggregation(unittest.TestCase):
+
+    def setUp(self):
+        self.agg = Aggregator()
+        paths = [VLIZ_DETECTIONS, VLIZ_2_DETECTIONS, INBO_DETECTIONS, VUE_DETECTIONS]
+        self.detections = pd.concat([self.agg.parse_detections(path, STATION_MAPPING) for path in paths])
+
+    def assertSameIntervals(self, intervals, expected):
+        self.assertEquals(list(intervals.columns), list(expected.columns))
+        for column in expected.columns:
+            self.assertEquals(list(intervals[column]), list(expected[column]))
+
+    def test_sharded_aggregate(self):
+        expected = self.agg.aggregate(self.detections, minutes_delta=30, time_format=None)
+        for shards in [1, 3, 16]:
+            self.assertSameIntervals(sharded.sharded_aggregate(self.agg, self.detections, 30, shards=shards), expected)
+        compact = self.agg.compact_detections(self.detections)
+        self.assertSameIntervals(sharded.sharded_aggregate(self.agg, compact, 30, shards=3, jobs=2), expected)
+
+    def test_several_thresholds(self):
+        expected = self.agg.aggregate(self.detections, minutes_delta=[10, 60], time_format=None)
+        self.assertSameIntervals(sharded.sharded_aggregate(self.agg, self.detections, [10, 60], shards=3), expected)
+
+    def test_isolated_detections_are_counted(self):
+        agg = Aggregator(isolation_window=600)
+        expected = agg.aggregate(self.detections, minutes_delta=30, time_format=None)
+        removed = agg.isolated_removed
+        agg.isolated_removed = 0
+        self.assertSameIntervals(sharded.sharded_aggregate(agg, self.detections, 30, shards=3, jobs=2), expected)
+        self.assertEquals(agg.isolated_removed, removed)
+
+class TestSyntheticDetections(unittest.TestCase):
+
+    def setUp(self):
+        self.agg = Aggregator()
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_layouts_parse_back(self):
+        """Every generated layout parses back to the generated detections, with the old station names mapped"""
+        expected = pd.concat(benchmark.generate_detections(500, transmitters=20, stations=30))
+        for layout in benchmark.LAYOUTS:
+            path, mapping = benchmark.dataset(self.workdir, layout, 500, 20, 30, 42)
+            detections = self.agg.parse_detections(path, station_mapping=mapping)
+            self.assertEqual(len(detections), 500)
+            self.assertEqual(list(detections['transmitter'].astype(str)), list(expected['transmitter']))
+            self.assertTrue(detections['stationname'].str.match('^ws-[0-9]+$').all())
+
+class TestOutput(unittest.TestCase):
+
+    def setUp(self):
+        self.agg = Aggregator()
+        self.detections = self.agg.parse_detections(VUE_DETECTIONS, STATION_MAPPING)
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_compressed_csv_in_chunks(self):
+        path = os.path.join(self.workdir, 'detections.csv.gz')
+        writer = output.open_writer(path)
+        writer.write(self.detections.iloc[:5])
+        writer.write(self.detections.iloc[5:])
+        writer.close()
+        result = pd.read_csv(path, compression='gzip', parse_dates=['timestamp'])
+        self.assertEquals(len(result), len(self.detections))
+        self.assertEquals(list(result['transmitter']), list(self.detections['transmitter']))
+
+    def test_partition_by_transmitter(self):
+        directory = os.path.join(self.workdir, 'detections')
+        writer = output.open_writer(directory, partition_by='transmitter')
+        writer.write(self.detections)
+        writer.write(self.detections)
+        writer.close()
+        transmitters = self.detections['transmitter'].unique()
+        self.assertEquals(sorted(os.listdir(directory)), sorted('transmitter=' + t for t in transmitters))
+        part = pd.read_csv(os.path.join(directory, 'transmitter=' + transmitters[0], 'part-00000.csv'))
+        self.assertEquals(len(part), 2 * (self.detections['transmitter'] == transmitters[0]).sum())
+
+    def test_atomic_writer_replaces_output(self):
+        path = os.path.join(self.workdir, 'detections.csv')
+        writer = output.open_writer(path, atomic=True)
+        writer.write(self.detections)
+        self.assertFalse(os.path.exists(path))
+        writer.close()
+        writer = output.open_writer(path, atomic=True)
+        writer.write(self.detections.iloc[:3])
+        # the previous output stays in place until the new one is complete
+        self.assertEquals(len(pd.read_csv(path)), len(self.detections))
+        writer.close()
+        self.assertEquals(len(pd.read_csv(path)), 3)
+        self.assertEquals(os.listdir(self.workdir), ['detections.csv'])
+
+    def test_atomic_writer_replaces_partitions(self):
+        directory = os.path.join(self.workdir, 'detections')
+        for detections in [self.detections, self.detections.iloc[:3]]:
+            writer = output.open_writer(directory, partition_by='transmitter', atomic=True)
+            writer.write(detections)
+            writer.close()
+        transmitters = self.detections['transmitter'].iloc[:3].unique()
+        self.assertEquals(sorted(os.listdir(directory)), sorted('transmitter=' + t for t in transmitters))
+        self.assertEquals(os.listdir(self.workdir), ['detections'])
+
+    def test_stdout_is_plain_csv(self):
+        self.assertRaises(Exception, output.open_writer, '-', output_format='parquet')
+        self.assertRaises(Exception, output.open_writer, '-', partition_by='month')
+
+class TestDetectionStore(unittest.TestCase):
+
+    def setUp(self):
+        self.agg = Aggregator()
+        self.workdir = tempfile.mkdtemp()
+        self.store = DetectionStore(os.path.join(self.workdir, 'detections.db'), self.agg)
+        self.paths = [VLIZ_DETECTIONS, VUE_DETECTIONS]
+        self.detections = dict((path, self.agg.parse_detections(path, STATION_MAPPING)) for path in self.paths)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.workdir)
+
+    def load(self, paths):
+        transmitters = set()
+        for path in paths:
+            transmitters.update(self.store.load_file(path, self.detections[path]))
+        self.store.update_intervals(transmitters, minutes_delta=30)
+
+    def test_reload_is_idempotent(self):
+        self.load(self.paths)
+        self.assertEquals(self.store.changed_files(self.paths), [])
+        self.load(self.paths)
+        self.assertEquals(len(self.store.query()), sum(len(d) for d in self.detections.values()))
+        expected = self.agg.intervals(self.agg.sort_detections(pd.concat(self.detections.values())), minutes_delta=30)
+        self.assertTrue(sort_intervals(self.store.query('intervals'))[expected.columns].equals(sort_intervals(expected)))
+
+    def test_query(self):
+        self.load(self.paths)
+        result = self.store.query(transmitters=['A69-1601-14872'], start='2015-02-12 19:00', end='2015-02-12 20:00')
+        detections = self.detections[VLIZ_DETECTIONS]
+        expected = detections[(detections['transmitter'] == 'A69-1601-14872') &
+                              (detections['timestamp'] >= datetime(2015, 2, 12, 19)) &
+                              (detections['timestamp'] <= datetime(2015, 2, 12, 20))]
+        self.assertTrue(len(expected) > 0)
+        self.assertEquals(list(result['timestamp']), list(expected['timestamp']))
+
+    def test_pending_transmitters(self):
+        """Transmitters of loaded files stay pending until their intervals are updated, also after a reopen"""
+        transmitters = self.store.load_file(VLIZ_DETECTIONS, self.detections[VLIZ_DETECTIONS])
+        self.store.close()
+        self.store = DetectionStore(os.path.join(self.workdir, 'detections.db'), self.agg)
+        self.assertEquals(self.store.changed_files([VLIZ_DETECTIONS]), [])
+        self.assertEquals(self.store.pending_transmitters(), transmitters)
+        self.store.update_intervals(self.store.pending_transmitters(), minutes_delta=30)
+        self.assertEquals(self.store.pending_transmitters(), set())
+        self.assertTrue(len(self.store.query('intervals')) > 0)
+
+class TestDeduplicator(unittest.TestCase):
+
+    def setUp(self):
+        self.agg = Aggregator()
+        self.vliz = self.agg.parse_detections(VLIZ_DETECTIONS, STATION_MAPPING)
+        self.vliz_2 = self.agg.parse_detections(VLIZ_2_DETECTIONS, STATION_MAPPING)
+
+    def test_duplicates_across_files(self):
+        deduplicator = Deduplicator()
+        self.assertEquals(len(deduplicator.deduplicate('vliz_2', self.vliz_2)), len(self.vliz_2))
+        self.assertEquals(len(deduplicator.deduplicate('vliz', self.vliz)), 0)
+        report = deduplicator.report()
+        self.assertEquals(list(report.iloc[0]), ['vliz', 'vliz_2', len(self.vliz)])
+
+    def test_duplicates_within_file_are_kept(self):
+        deduplicator = Deduplicator()
+        doubled = pd.concat([self.vliz, self.vliz])
+        self.assertEquals(len(deduplicator.deduplicate('vliz', doubled)), len(doubled))
+
+    def test_tolerance(self):
+        """Timestamps truncated to the minute only match with a tolerance of 60 seconds"""
+        truncated = self.vliz.copy()
+        truncated['timestamp'] = truncated['timestamp'].values.astype('datetime64[m]').astype('datetime64[ns]')
+        exact = Deduplicator()
+        exact.deduplicate('vliz', self.vliz)
+        self.assertEquals(len(exact.deduplicate('inbo', truncated)), len(truncated))
+        tolerant = Deduplicator(tolerance=60)
+        tolerant.deduplicate('vliz', self.vliz)
+        self.assertEquals(len(tolerant.deduplicate('inbo', truncated)), 0)
+
+    def test_spilled_keys(self):
+        """Keys spilled to disk are found like the ones in memory"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            deduplicator = Deduplicator(max_keys=5, tmpdir=tmpdir)
+            half = len(self.vliz) // 2
+            self.assertEquals(len(deduplicator.deduplicate('first', self.vliz[:half])), half)
+            self.assertEquals(deduplicator.in_memory, 0)
+            self.assertEquals(len(deduplicator.deduplicate('vliz_2', self.vliz_2)), len(self.vliz_2) - half)
+            self.assertEquals(len(deduplicator.deduplicate('vliz', self.vliz)), 0)
+            self.assertEquals(deduplicator.removed(), half + len(self.vliz))
+            deduplicator.close()
+            self.assertEquals(os.listdir(tmpdir), [])
+        finally:
+            shutil.rmtree(tmpdir)
+
+class TestSpeedFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.agg = Aggregator()
+        self.workdir = tempfile.mkdtemp()
+        # GUD1 - GUD2 is 241 m, GUD1 - RAN1 13933 m
+        self.intervals = pd.DataFrame(data={
+            'start': pd.to_datetime(['2004-05-01 10:00', '2004-05-01 10:30', '2004-05-01 11:00', '2004-05-01 10:00', '2004-05-01 10:01']),
+            'stop': pd.to_datetime(['2004-05-01 10:10', '2004-05-01 10:40', '2004-05-01 11:10', '2004-05-01 10:00', '2004-05-01 10:01']),
+            'transmitter': ['A', 'A', 'A', 'B', 'B'],
+            'stationname': ['GUD1', 'GUD2', 'RAN1', 'GUD1', 'RAN1']
+        }, columns=['start', 'stop', 'transmitter', 'stationname'])
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_cached_matrix(self):
+        matrix = DistanceMatrix(DISTANCE_MATRIX)
+        DistanceMatrix(DISTANCE_MATRIX, cache_dir=self.workdir)
+        # the second time, the matrix is read from the cache
+        cached = DistanceMatrix(DISTANCE_MATRIX, cache_dir=self.workdir)
+        self.assertTrue(isinstance(cached.values, np.memmap))
+        distances = cached.lookup(['GUD1', 'GUD1', 'unknown'], ['GUD2', 'RAN1', 'GUD1'])
+        self.assertAlmostEquals(distances[0], 241.365818794614)
+        self.assertEquals(distances[1], matrix.lookup(['GUD1'], ['RAN1'])[0])
+        self.assertTrue(np.isnan(distances[2]))
+
+    def test_flag_implausible_moves(self):
+        speed_filter = SpeedFilter(DistanceMatrix(DISTANCE_MATRIX), max_speed=1.0)
+        result = speed_filter.filter_sorted(self.intervals)
+        # 13933 m in 20 minutes and in 1 minute are too fast
+        self.assertEquals(list(result['implausible_speed']), [False, False, True, False, True])
+        species = pd.Series(['eel', 'salmon'], index=['A', 'B'])
+        speed_filter = SpeedFilter(DistanceMatrix(DISTANCE_MATRIX), max_speed=1.0, species=species,
+                                   species_speeds={'eel': 20.0}, drop=True)
+        self.assertEquals(len(speed_filter.filter(self.intervals.iloc[::-1], self.agg)), 4)
+
+    def test_chunks(self):
+        speed_filter = SpeedFilter(DistanceMatrix(DISTANCE_MATRIX), max_speed=1.0)
+        chunks = [speed_filter.filter_sorted(self.intervals.iloc[start:start + 2]) for start in range(0, 5, 2)]
+        self.assertEquals(list(pd.concat(chunks)['implausible_speed']), [False, False, True, False, True])
+
+class TestNetwork(unittest.TestCase):
+
+    def setUp(self):
+        # unix timestamps as written by Aggregator.aggregate, not sorted
+        self.intervals = pd.DataFrame(data={
+            'start': ['100', '0', '300', '1000', '50'],
+            'stop': ['200', '10', '400', '1100', '60'],
+            'transmitter': ['A', 'A', 'A', 'A', 'B'],
+            'stationname': ['s-1', 's-2', 's-1', 's-2', 's-1']
+        })
+
+    def test_transitions(self):
+        result = network.transitions(self.intervals)
+        self.assertEquals(list(result['receiver1']), ['s-2', 's-1'])
+        self.assertEquals(list(result['receiver2']), ['s-1', 's-2'])
+        # the two intervals at s-1 are one visit, left at 400
+        self.assertEquals(list(result['transit_seconds']), [90, 600])
+        self.assertEquals(len(network.transitions(self.intervals, allow_loops=True)), 3)
+
+    def test_edges(self):
+        intervals = pd.concat([self.intervals, pd.DataFrame(data={
+            'start': ['2000'], 'stop': ['2000'], 'transmitter': ['A'], 'stationname': ['s-1']})])
+        result = network.edges(network.transitions(intervals))
+        self.assertEquals(list(result.columns[:3]), ['receiver1', 'receiver2', 'freq'])
+        self.assertEquals(list(result['freq']), [1, 2])
+        self.assertEquals(list(result['mean_transit_seconds']), [600, 495])
+        self.assertEquals(result['first_transition'].iloc[1], pd.Timestamp(100, unit='s'))
+
+class TestResidency(unittest.TestCase):
+
+    def setUp(self):
+        self.intervals = pd.DataFrame(data={
+            'start': ['3500', '7300', '100', '86400'],
+            'stop': ['7300', '7400', '100', '86400'],
+            'transmitter': ['A', 'A', 'A', 'B'],
+            'stationname': ['s-1', 's-1', 's-2', 's-1']
+        })
+
+    def test_summarize(self):
+        result = residency.summarize(self.intervals, '1H')
+        self.assertEquals(list(result['transmitter']), ['A', 'A', 'A', 'A', 'B'])
+        self.assertEquals(list(result['stationname']), ['s-1', 's-1', 's-1', 's-2', 's-1'])
+        self.assertEquals(list(result['bin']), [pd.Timestamp(hour * 3600, unit='s') for hour in [0, 1, 2, 0, 24]])
+        # the first interval is split over three hours, the second one falls in the third hour too
+        self.assertEquals(list(result['residence_seconds']), [100, 3600, 200, 0, 0])
+        self.assertEquals(list(result['intervals']), [1, 1, 2, 1, 1])
+
+    def test_total_residence(self):
+        result = residency.total_residence(residency.summarize(self.intervals, '1D'))
+        self.assertEquals(list(result['residence_seconds']), [3900, 0, 0])
+        self.assertEquals(list(result['bins_present']), [1, 1, 1])
+        self.assertEquals(result['last_bin'].iloc[2], pd.Timestamp('1970-01-02'))
+
+    def test_bin_seconds(self):
+        self.assertEquals(residency.bin_seconds('15min'), 900)
+        self.assertEquals(residency.bin_seconds('1D'), 86400)
+        self.assertRaises(ValueError, residency.bin_seconds, '0s')
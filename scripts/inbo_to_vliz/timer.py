@@ -1,4 +1,44 @@
+import resource
 import time
+import pandas as pd
+
+def current_rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 1024.0 / 1024.0
+
+# stages that are running in this process, the innermost last
+running = []
+# the highest peak seen before a stage reset it
+reset_peak_mb = 0.0
+
+def high_water_mb():
+    """Return the peak RSS since the last reset_high_water, or None without /proc/self/status"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    return None
+
+def reset_high_water():
+    """Reset the peak RSS to the current RSS, and return whether that is supported"""
+    global reset_peak_mb
+    peak = high_water_mb()
+    if peak is None:
+        return False
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        return False
+    reset_peak_mb = max(reset_peak_mb, peak)
+    return True
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, and can be lowered by reset_high_water
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, reset_peak_mb)
 
 class Timer(object):
     def __init__(self, verbose=False):
@@ -13,4 +53,79 @@ class Timer(object):
         self.secs = self.end - self.start
         self.msecs = self.secs * 1000  # millisecs
         if self.verbose:
-            print 'elapsed time: %f ms' % self.msecs
\ No newline at end of file
+            print 'elapsed time: %f ms' % self.msecs
+
+class Stage(Timer):
+    """
+    Timer for one run of a stage, that adds its wall time, rows and peak RSS to metrics on exit. The time of stages
+    that run within it, such as formatting while writing, is left out, so it is not counted twice. The peak RSS of
+    the process is reset when the stage starts, so it includes memory freed again within the stage. Where the peak
+    can not be reset, it is the peak of the process so far.
+    """
+    def __init__(self, metrics, name, rows_in=None):
+        super(Stage, self).__init__()
+        self.metrics = metrics
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+
+    def __enter__(self):
+        self.nested_secs = 0.0
+        self.peak_rss = 0.0
+        # the stages around this one keep the peak so far
+        peak = high_water_mb()
+        for stage in running:
+            stage.peak_rss = max(stage.peak_rss, peak)
+        self.reset = reset_high_water()
+        running.append(self)
+        return super(Stage, self).__enter__()
+
+    def __exit__(self, *args):
+        super(Stage, self).__exit__(*args)
+        running.remove(self)
+        if running:
+            running[-1].nested_secs += self.secs
+        self.peak_rss = max(self.peak_rss, high_water_mb()) if self.reset else peak_rss_mb()
+        self.metrics.add(self.name, self.secs - self.nested_secs, self.rows_in, self.rows_out, self.peak_rss)
+
+STAGE_FIELDS = ['calls', 'seconds', 'rows_in', 'rows_out', 'peak_rss_mb']
+
+class Metrics(object):
+    """Totals per stage of all the Stage timers started with stage(), in the order the stages first ran"""
+    def __init__(self):
+        self.stages = []
+        self.totals = {}
+
+    def stage(self, name, rows_in=None):
+        return Stage(self, name, rows_in)
+
+    def add(self, name, seconds, rows_in=None, rows_out=None, peak_rss=0.0, calls=1):
+        if name not in self.totals:
+            self.stages.append(name)
+            self.totals[name] = dict((field, 0) for field in STAGE_FIELDS)
+        totals = self.totals[name]
+        totals['calls'] += calls
+        totals['seconds'] += seconds
+        totals['rows_in'] += rows_in or 0
+        totals['rows_out'] += rows_out or 0
+        totals['peak_rss_mb'] = max(totals['peak_rss_mb'], peak_rss)
+
+    def merge(self, other):
+        """Add the totals of other, e.g. the metrics recorded in a worker process"""
+        for name in other.stages:
+            totals = other.totals[name]
+            self.add(name, totals['seconds'], totals['rows_in'], totals['rows_out'], totals['peak_rss_mb'], totals['calls'])
+
+    def report(self):
+        """Return the totals as a list of dicts, with rows_per_sec computed from rows_in, or rows_out for sources"""
+        report = []
+        for name in self.stages:
+            totals = self.totals[name]
+            rows = totals['rows_in'] or totals['rows_out']
+            rows_per_sec = rows / totals['seconds'] if totals['seconds'] > 0 else None
+            report.append(dict(totals, stage=name, rows_per_sec=rows_per_sec))
+        return report
+
+    def to_string(self):
+        columns = ['stage'] + STAGE_FIELDS[:-1] + ['rows_per_sec', 'peak_rss_mb']
+        return pd.DataFrame(self.report(), columns=columns).to_string(index=False, float_format=lambda x: '{0:.3f}'.format(x))
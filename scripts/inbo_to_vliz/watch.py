@@ -0,0 +1,37 @@
+import os
+import time
+
+class DirectoryWatcher():
+    """
+    Select the detection files that are new or changed since they were ingested by incremental (an
+    IncrementalAggregator), once they are complete. A file is ready when it was not modified for settle seconds, so a
+    file that is still being copied into the directory is not parsed half, and a burst of files is picked up as one
+    batch once it has landed. At most batch_size files are returned at a time, the oldest first.
+
+    Files that could not be parsed are skipped until they change again.
+    """
+    def __init__(self, incremental, settle=30, batch_size=200):
+        self.incremental = incremental
+        self.settle = settle
+        self.batch_size = batch_size
+        self.failed = {}
+
+    def ready(self, paths, now=None):
+        now = time.time() if now is None else now
+        ready = []
+        for path in paths:
+            try:
+                mtime = os.path.getmtime(path)
+                if now - mtime < self.settle or not self.incremental.changed_files([path]):
+                    continue
+                if self.failed.get(path) == self.incremental.fingerprint(path):
+                    continue
+            except OSError:
+                # moved or deleted while it was looked at, a next round sees where it went
+                continue
+            ready.append((mtime, path))
+        ready.sort(key=lambda entry: entry[0])
+        return [path for mtime, path in ready[:self.batch_size]]
+
+    def fail(self, path):
+        self.failed[path] = self.incremental.fingerprint(path)